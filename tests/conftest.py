@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+# IMPORTS ##############################################################################################################
+
+# Standard library imports
+import os
+import sys
+
+# Make the package importable when running pytest from a source checkout without installing it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
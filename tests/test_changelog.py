@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+# IMPORTS ##############################################################################################################
+
+# Local imports
+import versipy.common
+from versipy.common import group_commits_by_version
+
+# TESTS ################################################################################################################
+
+
+def test_group_commits_by_version(monkeypatch):
+    from_entry = (1000.7, "1.0", "Bump 1.0")
+    entries = [(2000.5, "1.1", "Bump 1.1"), (3000.2, "1.2", "Bump 1.2")]
+    # Commits as listed by git log, most recent first
+    commits = [
+        ("c9", 3100, "a", "After 1.2"),
+        ("c8", 3050, "a", "Bump 1.2"),
+        ("c7", 3000, "a", "Same second as 1.2"),
+        ("c6", 2020, "a", "Bump 1.1"),
+        ("c5", 2010, "a", "Bump 1.1"),
+        ("c4", 2000, "a", "Same second as 1.1"),
+        ("c3", 1500, "a", "Feature"),
+        ("c2", 1000, "a", "Same second as 1.0"),
+        ("c1", 1000, "a", "Bump 1.0"),
+    ]
+    calls = []
+
+    def iter_git_log(since_ts, until_ts):
+        calls.append((since_ts, until_ts))
+        return iter(commits)
+
+    monkeypatch.setattr(versipy.common, "iter_git_log", iter_git_log)
+    groups = group_commits_by_version(from_entry, entries, grace=300)
+
+    # History times are rounded down to the second like commit times
+    assert calls == [(1000, 3300)]
+    # Commits made after the last version are excluded, except the versipy commit of this version
+    assert [[c[0] for c in g] for g in groups] == [["c5", "c3", "c2"], ["c8", "c6", "c4"]]
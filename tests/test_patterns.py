@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+# IMPORTS ##############################################################################################################
+
+# Standard library imports
+import json
+import logging
+import os
+from collections import OrderedDict
+
+# Third party imports
+import pytest
+
+# Local imports
+from versipy.common import glob_to_regex, get_managed_files
+
+# FIXTURES #############################################################################################################
+
+
+@pytest.fixture
+def templates(tmp_path, monkeypatch):
+    """Template directory with a few files in nested directories"""
+    for fn in ["templates/a.py", "templates/b.txt", "templates/sub/c.py"]:
+        (tmp_path / fn).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / fn).write_text("__package_version__\n")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+# TESTS ################################################################################################################
+
+
+@pytest.mark.parametrize(
+    "pattern, fn, match",
+    [
+        ("*.py", "a.py", True),
+        ("*.py", "sub/a.py", False),
+        ("**/*.py", "sub/a.py", True),
+        ("[!a]b", "xb", True),
+        ("[!a]b", "ab", False),
+        ("[!a]b", "/b", False),
+        ("[a!]b", "!b", True),
+        ("[a!]b", "^b", False),
+        ("[^a]", "^", True),
+        ("[^a]", "b", False),
+        ("[]a]", "]", True),
+        ("[\\]", "\\", True),
+        ("a[b", "a[b", True),
+    ],
+)
+def test_glob_to_regex(pattern, fn, match):
+    assert bool(glob_to_regex(pattern).match(fn)) == match
+
+
+def test_get_managed_files_saves_cache(templates):
+    info_d = {"managed_files": OrderedDict([("templates/**/*.py", "out"), ("templates/b.txt", "b.txt")])}
+    files_d = get_managed_files(info_d, log=logging.getLogger("test"), cache_fn="cache.json")
+    assert files_d == OrderedDict(
+        [("templates/a.py", "out/a.py"), ("templates/sub/c.py", "out/sub/c.py"), ("templates/b.txt", "b.txt")]
+    )
+
+    entry = json.loads((templates / "cache.json").read_text())["managed_files"]["templates/**/*.py"]
+    assert entry["dest"] == "out"
+    assert entry["files"] == [["templates/a.py", "out/a.py"], ["templates/sub/c.py", "out/sub/c.py"]]
+
+    # Cached expansions are reused until a walked directory is modified
+    assert get_managed_files(info_d, log=logging.getLogger("test"), cache_fn="cache.json") == files_d
+    (templates / "templates" / "sub" / "d.py").write_text("")
+    os.utime(str(templates / "templates" / "sub"), ns=(0, 0))
+    files_d = get_managed_files(info_d, log=logging.getLogger("test"), cache_fn="cache.json")
+    assert files_d["templates/sub/d.py"] == "out/sub/d.py"
+
+
+def test_get_managed_files_overlapping_patterns(templates):
+    info_d = {"managed_files": OrderedDict([("templates/*.py", "out"), ("templates", "other")])}
+    with pytest.raises(ValueError, match="matched by several managed_files entries"):
+        get_managed_files(info_d, log=logging.getLogger("test"), cache_fn="")
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# IMPORTS ##############################################################################################################
+
+# Standard library imports
+import json
+
+# Third party imports
+import pytest
+from git import Repo
+
+# Local imports
+from versipy.versipy import bump_up_version
+
+# FIXTURES #############################################################################################################
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """Versipy project in a git repository with a local bare remote"""
+    remote_dir = tmp_path / "remote.git"
+    Repo.init(str(remote_dir), bare=True)
+
+    project_dir = tmp_path / "project"
+    (project_dir / "templates").mkdir(parents=True)
+    (project_dir / "templates" / "version.txt").write_text("__package_name__ __package_version__\n")
+    (project_dir / "versipy.yaml").write_text(
+        "version:\n  major: 0\n  minor: 1\n  micro: 0\n  a: null\n  b: null\n  rc: null\n  post: null\n  dev: null\n"
+        "managed_values:\n  __package_name__: demo\n"
+        "managed_files:\n  templates/version.txt: version.txt\n"
+    )
+    (project_dir / "versipy_history.txt").write_text("2020-01-01 00:00:00.000000\t0.1.0\tInitial version\n")
+    (project_dir / "version.txt").write_text("demo 0.1.0\n")
+
+    repo = Repo.init(str(project_dir))
+    with repo.config_writer() as cw:
+        cw.set_value("user", "name", "versipy")
+        cw.set_value("user", "email", "versipy@localhost")
+    repo.git.add(A=True)
+    repo.git.commit(m="Initial commit")
+    repo.create_remote("origin", str(remote_dir))
+    repo.git.push("origin", repo.active_branch.name)
+
+    monkeypatch.chdir(project_dir)
+    return repo, Repo(str(remote_dir))
+
+
+# TESTS ################################################################################################################
+
+
+def test_pipeline_push_commit_and_tag(project):
+    repo, remote = project
+    bump_up_version(
+        micro=True,
+        overwrite=True,
+        git_push=True,
+        git_tag=True,
+        pipeline=True,
+        comment="Pipeline bump",
+        quiet=True,
+    )
+
+    # Rendered file and versipy files are committed together
+    head = repo.head.commit
+    assert head.message == "Pipeline bump"
+    assert set(head.stats.files) == {"version.txt", "versipy.yaml", "versipy_history.txt"}
+    assert head.tree["version.txt"].data_stream.read() == b"demo 0.1.1\n"
+
+    # Branch and tag are pushed to the remote
+    branch = repo.active_branch.name
+    assert remote.commit(branch).hexsha == head.hexsha
+    assert remote.tags["0.1.1"].commit.hexsha == head.hexsha
+
+    # The index matches both HEAD and the working tree
+    assert not repo.index.diff("HEAD")
+    assert not repo.index.diff(None)
+    assert not repo.is_dirty(untracked_files=False)
+
+
+# Without pipeline the tag is only created once the branch is pushed
+@pytest.mark.parametrize("pipeline, tags", [(False, []), (True, ["0.1.1"])])
+def test_rejected_push_keeps_commit_and_tags(project, tmp_path, capsys, pipeline, tags):
+    repo, remote = project
+    # Move the remote branch ahead so that the push is rejected as non fast-forward
+    other = Repo.clone_from(remote.working_dir, str(tmp_path / "other"))
+    with other.config_writer() as cw:
+        cw.set_value("user", "name", "versipy")
+        cw.set_value("user", "email", "versipy@localhost")
+    other.git.commit(m="Concurrent commit", allow_empty=True)
+    other.git.push("origin", other.active_branch.name)
+
+    bump_up_version(
+        micro=True,
+        overwrite=True,
+        git_push=True,
+        git_tag=True,
+        pipeline=pipeline,
+        comment="Rejected bump",
+        json_output=True,
+    )
+    git_res = json.loads(capsys.readouterr().out)["git"]
+
+    assert git_res["commit"] == repo.head.commit.hexsha
+    assert git_res["tags"] == tags
+    assert [t.name for t in repo.tags] == tags
+    assert git_res["pushed"] is False
+    assert git_res["error"]
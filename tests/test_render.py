@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+# IMPORTS ##############################################################################################################
+
+# Standard library imports
+import logging
+from collections import OrderedDict
+
+# Third party imports
+import pytest
+
+# Local imports
+from versipy.common import get_render_values, parse_version_str, render_string, resolve_managed_values
+
+# TESTS ################################################################################################################
+
+
+def test_resolve_managed_values_references():
+    managed_values = OrderedDict(
+        [("__url__", "https://example.com/__name__/__package_version__"), ("__name__", "demo"), ("__year__", 2020)]
+    )
+    resolved_d = resolve_managed_values(managed_values, "1.2.0")
+    assert resolved_d["__url__"] == "https://example.com/demo/1.2.0"
+    assert resolved_d["__year__"] == "2020"
+    assert resolved_d["__package_version__"] == "1.2.0"
+
+
+@pytest.mark.parametrize(
+    "managed_values, path",
+    [
+        (OrderedDict([("__a__", "__b__"), ("__b__", "__a__")]), "__a__ > __b__ > __a__"),
+        (OrderedDict([("__a__", "x __a__")]), "__a__ > __a__"),
+        (OrderedDict([("__a__", "__b__"), ("__b__", "__c__"), ("__c__", "__b__")]), "__a__ > __b__ > __c__ > __b__"),
+    ],
+)
+def test_resolve_managed_values_circular_reference(managed_values, path):
+    with pytest.raises(ValueError, match="Circular reference in managed values: {}".format(path)):
+        resolve_managed_values(managed_values, "1.0")
+
+
+def test_render_string_single_pass():
+    info_d = {
+        "version": parse_version_str(version_str="1.0.0", log=logging.getLogger("test")),
+        "managed_values": OrderedDict([("__name__", "demo"), ("__name_long__", "__name__ tool")]),
+    }
+    render_values = get_render_values(info_d)
+    assert render_string("__name_long__ __name__ __package_version__", render_values) == "demo tool demo 1.0.0"
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# IMPORTS ##############################################################################################################
+
+# Standard library imports
+import logging
+import os
+
+# Third party imports
+import pytest
+
+# Local imports
+from versipy.common import FileTransaction
+
+# TESTS ################################################################################################################
+
+
+def test_commit(tmp_path):
+    (tmp_path / "a.txt").write_text("old a\n")
+    transaction = FileTransaction(log=logging.getLogger("test"))
+    transaction.write(str(tmp_path / "a.txt"), "new a\n")
+    transaction.append(str(tmp_path / "a.txt"), "more a\n")
+    transaction.write(str(tmp_path / "sub" / "b.txt"), "new b\n")
+
+    # Nothing is modified before commit
+    assert (tmp_path / "a.txt").read_text() == "old a\n"
+    assert not (tmp_path / "sub" / "b.txt").exists()
+
+    assert transaction.commit() == [str(tmp_path / "a.txt"), str(tmp_path / "sub" / "b.txt")]
+    assert (tmp_path / "a.txt").read_text() == "new a\nmore a\n"
+    assert (tmp_path / "sub" / "b.txt").read_text() == "new b\n"
+    assert sorted(os.listdir(str(tmp_path))) == ["a.txt", "sub"]
+
+
+def test_commit_rollback(tmp_path, monkeypatch):
+    (tmp_path / "a.txt").write_text("old a\n")
+    (tmp_path / "c.txt").write_text("old c\n")
+    transaction = FileTransaction(log=logging.getLogger("test"))
+    for fn in ["a.txt", "b.txt", "c.txt"]:
+        transaction.write(str(tmp_path / fn), "new\n")
+
+    # Fail when replacing the last file, after the first two were replaced
+    failing_tmp_fn = transaction.staged[str(tmp_path / "c.txt")]
+    os_replace = os.replace
+
+    def replace(src, dst):
+        if src == failing_tmp_fn:
+            raise OSError("Simulated failure")
+        os_replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", replace)
+    with pytest.raises(IOError, match="Failed to commit file changes"):
+        transaction.commit()
+
+    # Replaced files are restored, new files removed, and no temporary file is left
+    assert (tmp_path / "a.txt").read_text() == "old a\n"
+    assert (tmp_path / "c.txt").read_text() == "old c\n"
+    assert sorted(os.listdir(str(tmp_path))) == ["a.txt", "c.txt"]
+    assert len(transaction) == 0
+    assert transaction.committed == []
@@ -9,7 +9,21 @@ import sys
 # Local imports
 import versipy as pkg
 from versipy.common import *
-from versipy.versipy import init_repo, current_version, bump_up_version, set_version
+from versipy.versipy import (
+    init_repo,
+    current_version,
+    bump_up_version,
+    set_version,
+    check,
+    scan_stale,
+    serve,
+    serve_bench,
+    render_matrix,
+    changelog,
+    bulk_version,
+    generate_project,
+    stress_test,
+)
 
 # ~~~~~~~~~~~~~~TOP LEVEL ENTRY POINT~~~~~~~~~~~~~~#
 def main(args=None):
@@ -56,6 +70,14 @@ def main(args=None):
     arg_from_docstr(sp_bv_ms, f, "git_tag", "t")
     arg_from_docstr(sp_bv_ms, f, "comment", "c")
     arg_from_docstr(sp_bv_ms, f, "dry")
+    arg_from_docstr(sp_bv_ms, f, "dry_json")
+    arg_from_docstr(sp_bv_ms, f, "threads")
+    arg_from_docstr(sp_bv_ms, f, "lock", "l")
+    arg_from_docstr(sp_bv_ms, f, "optimistic")
+    arg_from_docstr(sp_bv_ms, f, "retries")
+    arg_from_docstr(sp_bv_ms, f, "pipeline")
+    arg_from_docstr(sp_bv_ms, f, "render_cache_dir")
+    arg_from_docstr(sp_bv_ms, f, "render_cache_size")
 
     f = set_version
     sp_sv = subparsers.add_parser("set_version", description=doc_func(f))
@@ -71,12 +93,137 @@ def main(args=None):
     arg_from_docstr(sp_sv_ms, f, "git_tag", "t")
     arg_from_docstr(sp_sv_ms, f, "comment", "c")
     arg_from_docstr(sp_sv_ms, f, "dry")
+    arg_from_docstr(sp_sv_ms, f, "dry_json")
+    arg_from_docstr(sp_sv_ms, f, "threads")
+    arg_from_docstr(sp_sv_ms, f, "lock", "l")
+    arg_from_docstr(sp_sv_ms, f, "optimistic")
+    arg_from_docstr(sp_sv_ms, f, "retries")
+    arg_from_docstr(sp_sv_ms, f, "pipeline")
+    arg_from_docstr(sp_sv_ms, f, "render_cache_dir")
+    arg_from_docstr(sp_sv_ms, f, "render_cache_size")
+
+    f = check
+    sp_ck = subparsers.add_parser("check", description=doc_func(f))
+    sp_ck.set_defaults(func=f)
+    sp_ck_io = sp_ck.add_argument_group("IO options")
+    arg_from_docstr(sp_ck_io, f, "versipy_fn")
+    arg_from_docstr(sp_ck_io, f, "cache_fn")
+    sp_ck_ms = sp_ck.add_argument_group("Misc options")
+    arg_from_docstr(sp_ck_ms, f, "diff")
+    arg_from_docstr(sp_ck_ms, f, "threads")
+
+    f = scan_stale
+    sp_ss = subparsers.add_parser("scan_stale", description=doc_func(f))
+    sp_ss.set_defaults(func=f)
+    sp_ss_opt = sp_ss.add_argument_group("Versioning options")
+    arg_from_docstr(sp_ss_opt, f, "old_version")
+    arg_from_docstr(sp_ss_opt, f, "new_version")
+    sp_ss_io = sp_ss.add_argument_group("IO options")
+    arg_from_docstr(sp_ss_io, f, "versipy_history_fn")
+    sp_ss_ms = sp_ss.add_argument_group("Misc options")
+    arg_from_docstr(sp_ss_ms, f, "threads")
+
+    f = serve
+    sp_se = subparsers.add_parser("serve", description=doc_func(f))
+    sp_se.set_defaults(func=f)
+    sp_se_io = sp_se.add_argument_group("IO options")
+    arg_from_docstr(sp_se_io, f, "versipy_fn")
+    arg_from_docstr(sp_se_io, f, "versipy_history_fn")
+    sp_se_ms = sp_se.add_argument_group("Server options")
+    arg_from_docstr(sp_se_ms, f, "host")
+    arg_from_docstr(sp_se_ms, f, "port")
+    arg_from_docstr(sp_se_ms, f, "commit_interval")
+    arg_from_docstr(sp_se_ms, f, "comment", "c")
+
+    f = serve_bench
+    sp_sb = subparsers.add_parser("serve_bench", description=doc_func(f))
+    sp_sb.set_defaults(func=f)
+    sp_sb_ms = sp_sb.add_argument_group("Load test options")
+    arg_from_docstr(sp_sb_ms, f, "url")
+    arg_from_docstr(sp_sb_ms, f, "level")
+    arg_from_docstr(sp_sb_ms, f, "n_requests")
+    arg_from_docstr(sp_sb_ms, f, "threads")
+
+    f = render_matrix
+    sp_rm = subparsers.add_parser("render_matrix", description=doc_func(f))
+    sp_rm.set_defaults(func=f)
+    sp_rm_opt = sp_rm.add_argument_group("Versioning options")
+    arg_from_docstr(sp_rm_opt, f, "versions", "s")
+    arg_from_docstr(sp_rm_opt, f, "matrix_fn", "m")
+    sp_rm_io = sp_rm.add_argument_group("IO options")
+    arg_from_docstr(sp_rm_io, f, "output_dir", "o")
+    arg_from_docstr(sp_rm_io, f, "versipy_fn")
+    sp_rm_ms = sp_rm.add_argument_group("Misc options")
+    arg_from_docstr(sp_rm_ms, f, "threads")
+
+    f = changelog
+    sp_cl = subparsers.add_parser("changelog", description=doc_func(f))
+    sp_cl.set_defaults(func=f)
+    sp_cl_opt = sp_cl.add_argument_group("Versioning options")
+    arg_from_docstr(sp_cl_opt, f, "from_version", "f")
+    arg_from_docstr(sp_cl_opt, f, "to_version", "t")
+    sp_cl_io = sp_cl.add_argument_group("IO options")
+    arg_from_docstr(sp_cl_io, f, "versipy_history_fn")
+    arg_from_docstr(sp_cl_io, f, "output_fn", "o")
+
+    f = bulk_version
+    sp_bk = subparsers.add_parser("bulk_version", description=doc_func(f))
+    sp_bk.set_defaults(func=f)
+    sp_bk_io = sp_bk.add_argument_group("IO options")
+    arg_from_docstr(sp_bk_io, f, "manifest_fn", "m")
+    arg_from_docstr(sp_bk_io, f, "versipy_fn")
+    arg_from_docstr(sp_bk_io, f, "versipy_history_fn")
+    sp_bk_ms = sp_bk.add_argument_group("Misc options")
+    arg_from_docstr(sp_bk_ms, f, "git_push", "g")
+    arg_from_docstr(sp_bk_ms, f, "git_tag", "t")
+    arg_from_docstr(sp_bk_ms, f, "tag_format")
+    arg_from_docstr(sp_bk_ms, f, "comment", "c")
+    arg_from_docstr(sp_bk_ms, f, "dry")
+    arg_from_docstr(sp_bk_ms, f, "threads")
+    arg_from_docstr(sp_bk_ms, f, "lock", "l")
+
+    f = generate_project
+    sp_gp = subparsers.add_parser("generate_project", description=doc_func(f))
+    sp_gp.set_defaults(func=f)
+    sp_gp_io = sp_gp.add_argument_group("IO options")
+    arg_from_docstr(sp_gp_io, f, "project_dir", "o")
+    sp_gp_ms = sp_gp.add_argument_group("Project options")
+    arg_from_docstr(sp_gp_ms, f, "n_files")
+    arg_from_docstr(sp_gp_ms, f, "n_values")
+    arg_from_docstr(sp_gp_ms, f, "file_size")
+    arg_from_docstr(sp_gp_ms, f, "n_large_files")
+    arg_from_docstr(sp_gp_ms, f, "large_file_size")
+    arg_from_docstr(sp_gp_ms, f, "n_history")
+    arg_from_docstr(sp_gp_ms, f, "git_remote", "g")
+
+    f = stress_test
+    sp_st = subparsers.add_parser("stress_test", description=doc_func(f))
+    sp_st.set_defaults(func=f)
+    sp_st_io = sp_st.add_argument_group("IO options")
+    arg_from_docstr(sp_st_io, f, "project_dir", "o")
+    arg_from_docstr(sp_st_io, f, "results_fn", "r")
+    arg_from_docstr(sp_st_io, f, "keep", "k")
+    sp_st_ms = sp_st.add_argument_group("Project options")
+    arg_from_docstr(sp_st_ms, f, "scales", "s")
+    arg_from_docstr(sp_st_ms, f, "file_size")
+    arg_from_docstr(sp_st_ms, f, "n_large_files")
+    arg_from_docstr(sp_st_ms, f, "large_file_size")
+    arg_from_docstr(sp_st_ms, f, "n_history")
+    arg_from_docstr(sp_st_ms, f, "git_push", "g")
+    arg_from_docstr(sp_st_ms, f, "threads")
 
     # Add common group parsers
-    for sp in [sp_init, sp_bv, sp_cv, sp_sv]:
+    for sp in [sp_init, sp_bv, sp_cv, sp_sv, sp_ck, sp_ss, sp_se, sp_sb, sp_rm, sp_cl, sp_bk, sp_gp, sp_st]:
         sp_vb = sp.add_argument_group("Verbosity options")
         sp_vb.add_argument("-v", "--verbose", action="store_true", default=False, help="Increase verbosity")
         sp_vb.add_argument("-q", "--quiet", action="store_true", default=False, help="Reduce verbosity")
+        sp_vb.add_argument(
+            "--json",
+            dest="json_output",
+            action="store_true",
+            default=False,
+            help="Print a single JSON record with the command results on stdout, without colored logs",
+        )
 
     # Parse args and call subfunction
     args = parser.parse_args()
@@ -10,12 +10,44 @@ import sys
 import inspect
 import datetime
 from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 import copy
 import string
+import hashlib
+import json
+import difflib
+import mmap
+import tempfile
+import shutil
+import time
+import random
+import threading
+import asyncio
+import subprocess
+import bisect
+import csv
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+# Platform specific imports
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # Third party imports
 import colorlog
-from git import Repo
+from git import Repo, RemoteProgress, BaseIndexEntry
+from git.exc import InvalidGitRepositoryError
+from git.index.fun import stat_mode_to_index_mode
+from gitdb import IStream
 import yaml
 
 # Local imports
@@ -34,6 +66,11 @@ def stdout_print(*args):
     sys.stdout.flush()
 
 
+def json_print(d):
+    """Write a record as a single JSON line to stdout"""
+    stdout_print(json.dumps(d) + "\n")
+
+
 def opt_summary(local_opt):
     """Simplifiy option dict creation"""
     d = OrderedDict()
@@ -50,7 +87,7 @@ def mkdir(fn, exist_ok=False):
     try:
         os.makedirs(fn, exist_ok=exist_ok)
     except:
-        raise pycoMethError("Error creating output folder `{}`".format(fn))
+        raise IOError("Error creating output folder `{}`".format(fn))
 
 
 def mkbasedir(fn, exist_ok=False):
@@ -72,19 +109,35 @@ def check_access(fn, read=False, write=False):
 
 
 def choose_option(choices=["y", "n"], message="Choose a valid option"):
+    """Prompt the user on stderr until a valid option is entered, so that stdout only contains command results"""
     while True:
-        x = input("{} [{}]".format(message, ",".join(choices)))
+        sys.stderr.write("{} [{}]".format(message, ",".join(choices)))
+        sys.stderr.flush()
+        x = sys.stdin.readline()
+        if not x:
+            raise EOFError("No answer to prompt: {}".format(message))
+        x = x.strip()
         if x in choices:
             return x
         else:
-            print("{} is not a valid option".format(x))
+            sys.stderr.write("{} is not a valid option\n".format(x))
 
 
 # LOGGING FUNCTIONS ####################################################################################################
 
 
-def get_logger(name=None, verbose=False, quiet=False):
-    """Multilevel colored log using colorlog"""
+def get_logger(name=None, verbose=False, quiet=False, json_output=False):
+    """
+    Multilevel colored log using colorlog. With json_output, colorlog is not set up and the logger only reports errors
+    to stderr without colors, leaving stdout to the JSON record
+    """
+    if json_output:
+        # Standalone logger, not registered by name, so that loggers shared with other commands are left untouched
+        log = logging.Logger(name, level=logging.ERROR)
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter("ERROR: %(message)s"))
+        log.addHandler(handler)
+        return log
 
     # Define conditional color formatter
     formatter = colorlog.LevelFormatter(
@@ -261,7 +314,8 @@ def ordered_load_yaml(yaml_fn, Loader=yaml.Loader, **kwargs):
         pass
 
     def construct_mapping(loader, node):
-        loader.flatten_mapping(node)
+        if hasattr(loader, "flatten_mapping"):
+            loader.flatten_mapping(node)
         return OrderedDict(loader.construct_pairs(node))
 
     OrderedLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, construct_mapping)
@@ -278,6 +332,18 @@ def ordered_dump_yaml(d, yaml_fn, Dumper=yaml.Dumper, **kwargs):
     """
     Ensure ordered dict items are dumped in YAML file following the dictionary order
     """
+    # Try to dump dict to file
+    try:
+        with open(yaml_fn, "w") as yaml_fp:
+            yaml_fp.write(ordered_yaml_str(d, Dumper=Dumper, **kwargs))
+    except:
+        raise IOError("Error while trying to dump data in file: {}".format(yaml_fn))
+
+
+def ordered_yaml_str(d, Dumper=yaml.Dumper, **kwargs):
+    """
+    Dump ordered dict items in a YAML string following the dictionary order
+    """
     # Define custom dumper
     class OrderedDumper(Dumper):
         pass
@@ -286,13 +352,209 @@ def ordered_dump_yaml(d, yaml_fn, Dumper=yaml.Dumper, **kwargs):
         return dumper.represent_mapping(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, data.items())
 
     OrderedDumper.add_representer(OrderedDict, _dict_representer)
+    return yaml.dump(data=d, Dumper=OrderedDumper, **kwargs)
 
-    # Try to dump dict to file
+
+# ATOMIC FILE WRITING ##################################################################################################
+
+
+def fsync_dir(dir_fn):
+    """Flush a directory entry to disk. Not supported on all platforms, in which case it is a no-op"""
     try:
-        with open(yaml_fn, "w") as yaml_fp:
-            yaml.dump(data=d, stream=yaml_fp, Dumper=OrderedDumper, **kwargs)
-    except:
-        raise IOError("Error while trying to dump data in file: {}".format(yaml_fn))
+        fd = os.open(dir_fn, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class FileTransaction:
+    """
+    Stage new files content in temporary files created next to their destinations, then commit all of them at once
+    with atomic renames. If the commit phase fails, the files already replaced are restored from hard link backups.
+    Directories are synced once per directory after the commit rather than once per file. If a git object database is
+    given, each staged file is also stored as a git blob as soon as it is written, so that the files can later be added
+    to the git index without being read again. The files written by all the commits and the files that the user chose
+    not to overwrite are recorded in committed and skipped.
+    """
+
+    def __init__(self, log, odb=None):
+        self.log = log
+        self.odb = odb
+        self.staged = OrderedDict()
+        self.blobs = OrderedDict()
+        self.committed = []
+        self.skipped = []
+        umask = os.umask(0)
+        os.umask(umask)
+        self.mode = 0o666 & ~umask
+
+    def __len__(self):
+        return len(self.staged)
+
+    def _mkstemp(self, fn):
+        """Create a temporary file next to fn"""
+        dir_fn = os.path.dirname(os.path.abspath(fn))
+        try:
+            os.makedirs(dir_fn, exist_ok=True)
+            return tempfile.mkstemp(prefix=".{}.".format(os.path.basename(fn)), suffix=".tmp", dir=dir_fn)
+        except OSError:
+            raise IOError("Cannot write to destination file: {}".format(fn))
+
+    def _register(self, fn, tmp_fn):
+        """Optionally store the staged file as a git blob and record it"""
+        if self.odb is not None:
+            with open(tmp_fn, "rb") as fp:
+                self.blobs[fn] = self.odb.store(IStream(b"blob", os.path.getsize(tmp_fn), fp)).binsha
+        if fn in self.staged:
+            os.remove(self.staged[fn])
+        self.staged[fn] = tmp_fn
+
+    def write(self, fn, s):
+        """Stage the content of file fn"""
+        self.log.debug("Staging file {}".format(fn))
+        fd, tmp_fn = self._mkstemp(fn)
+        try:
+            with os.fdopen(fd, "w") as fp:
+                fp.write(s)
+                fp.flush()
+                os.fsync(fp.fileno())
+            if os.path.isfile(fn):
+                shutil.copymode(fn, tmp_fn)
+            else:
+                os.chmod(tmp_fn, self.mode)
+            self._register(fn, tmp_fn)
+        except:
+            os.remove(tmp_fn)
+            raise IOError("Cannot write to destination file: {}".format(fn))
+
+    def copy(self, fn, src_fn):
+        """Stage file fn as a copy of an existing file, keeping the mode of fn if it exists"""
+        self.log.debug("Staging file {} from {}".format(fn, src_fn))
+        fd, tmp_fn = self._mkstemp(fn)
+        os.close(fd)
+        try:
+            shutil.copyfile(src_fn, tmp_fn)
+            with open(tmp_fn, "rb") as fp:
+                os.fsync(fp.fileno())
+            if os.path.isfile(fn):
+                shutil.copymode(fn, tmp_fn)
+            else:
+                os.chmod(tmp_fn, self.mode)
+            self._register(fn, tmp_fn)
+        except:
+            if os.path.isfile(tmp_fn):
+                os.remove(tmp_fn)
+            raise IOError("Cannot write to destination file: {}".format(fn))
+
+    def append(self, fn, s):
+        """Stage the current content of file fn, or the previously staged content, followed by s"""
+        src_fn = self.staged.get(fn, fn)
+        old_s = ""
+        if os.path.isfile(src_fn):
+            with open(src_fn, "r") as fp:
+                old_s = fp.read()
+        self.write(fn, old_s + s)
+
+    def commit(self):
+        """Replace all destination files by their staged version, or restore the original files on failure"""
+        committed = []
+        try:
+            for fn, tmp_fn in self.staged.items():
+                bak_fn = None
+                if os.path.isfile(fn):
+                    bak_fn = tmp_fn + ".bak"
+                    try:
+                        os.link(fn, bak_fn)
+                    except OSError:
+                        shutil.copy2(fn, bak_fn)
+                os.replace(tmp_fn, fn)
+                committed.append((fn, bak_fn))
+        except Exception as E:
+            self.log.error("Failed to commit file changes, rolling back: {}".format(E))
+            for fn, bak_fn in reversed(committed):
+                if bak_fn:
+                    os.replace(bak_fn, fn)
+                else:
+                    os.remove(fn)
+            self.rollback()
+            raise IOError("Failed to commit file changes")
+
+        self.log.debug("Syncing directories")
+        for dir_fn in set(os.path.dirname(os.path.abspath(fn)) for fn, _ in committed):
+            fsync_dir(dir_fn)
+        for fn, bak_fn in committed:
+            if bak_fn:
+                os.remove(bak_fn)
+        self.staged.clear()
+        committed = [fn for fn, _ in committed]
+        self.committed.extend(committed)
+        return committed
+
+    def rollback(self):
+        """Discard all the staged files"""
+        for tmp_fn in self.staged.values():
+            for fn in [tmp_fn, tmp_fn + ".bak"]:
+                if os.path.isfile(fn):
+                    os.remove(fn)
+        self.staged.clear()
+        self.skipped.clear()
+        self.blobs.clear()
+
+
+# FILE LOCKING #########################################################################################################
+
+
+class FileLock:
+    """
+    Advisory exclusive lock on a hidden lock file created next to the protected file, to be used as a context manager.
+    Waits for the lock to be released by other processes until timeout is reached
+    """
+
+    def __init__(self, fn, log, timeout=300, poll_interval=0.05):
+        dir_fn, base_fn = os.path.split(fn)
+        self.lock_fn = os.path.join(dir_fn, ".{}.lock".format(base_fn))
+        self.log = log
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.fp = None
+
+    def _try_lock(self):
+        try:
+            if fcntl:
+                fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                self.fp.seek(0)
+                msvcrt.locking(self.fp.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def __enter__(self):
+        self.log.debug("Acquiring lock {}".format(self.lock_fn))
+        self.fp = open(self.lock_fn, "a")
+        start = time.time()
+        while not self._try_lock():
+            if time.time() - start > self.timeout:
+                self.fp.close()
+                raise IOError("Timeout while waiting for lock {}".format(self.lock_fn))
+            time.sleep(self.poll_interval)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.log.debug("Releasing lock {}".format(self.lock_fn))
+        try:
+            if fcntl:
+                fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+            else:
+                self.fp.seek(0)
+                msvcrt.locking(self.fp.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.fp.close()
 
 
 # VERSIPY SPECIFIC FUNCTIONS ###########################################################################################
@@ -424,7 +686,7 @@ def increment_version(
     # sanity check
     version_str = get_version_str(version_d)
     if not is_canonical_version(version_str):
-        raise ValueError("Current version {version_str} is not a valid PEP canonical version")
+        raise ValueError("Current version {} is not a valid PEP canonical version".format(version_str))
 
     log_dict(version_d, log.debug, "Updated version values")
     return version_d
@@ -433,7 +695,7 @@ def increment_version(
 def parse_version_str(version_str, log):
     """"""
     if not is_canonical_version(version_str):
-        raise ValueError("Current version {version_str} is not a valid PEP canonical version")
+        raise ValueError("Current version {} is not a valid PEP canonical version".format(version_str))
 
     log.debug("Split version number into a list")
     alphabet = list(string.ascii_letters)
@@ -471,59 +733,537 @@ def parse_version_str(version_str, log):
     return version_d
 
 
-def update_managed_files(info_d, overwrite, dry, log):
-    """"""
-    version_str = get_version_str(info_d["version"])
+def read_template(src_fn):
+    """Read a template file in text mode, with universal newlines and the default encoding"""
+    try:
+        with open(src_fn, "r") as src_fp:
+            return src_fp.read()
+    except:
+        raise IOError("Cannot read source Template file: {}".format(src_fn))
 
-    for src_fn, dest_fn in info_d["managed_files"].items():
-        log.debug("Updating file {}".format(dest_fn))
 
-        # Bulletproof reading and writing
-        try:
-            src_fp = dest_fp = None
+def render_template(src_fn, render_values):
+    """Read a template file and replace the placeholder keys by the managed values"""
+    return render_string(read_template(src_fn), render_values)
+
+
+def render_string(s, render_values):
+    """
+    Replace the placeholder keys by the resolved managed values in a template string, in a single pass. render_values
+    is the (values, regex) tuple returned by get_render_values
+    """
+    values_d, regex = render_values
+    return regex.sub(lambda m: values_d[m.group(0)], s)
+
 
-            # Open template file for reading
+def resolve_managed_values(managed_values, version_str):
+    """
+    Resolve managed values referencing other managed values or `__package_version__`. Each value is resolved once
+    following the dependency graph, and circular references raise a ValueError
+    """
+    raw_d = OrderedDict((k, str(v)) for k, v in managed_values.items())
+    raw_d["__package_version__"] = version_str
+    regex = get_placeholder_regex(raw_d)
+    resolved_d = OrderedDict()
+
+    def resolve(key, path):
+        if key in resolved_d:
+            return resolved_d[key]
+        if key in path:
+            raise ValueError("Circular reference in managed values: {}".format(" > ".join(path + [key])))
+        tokens = tokenize_template(raw_d[key], regex)
+        values_d = {k: resolve(k, path + [key]) for k in set(tokens[1::2])}
+        resolved_d[key] = render_tokens(tokens, values_d)
+        return resolved_d[key]
+
+    for key in raw_d:
+        resolve(key, [])
+    return resolved_d
+
+
+def get_render_values(info_d):
+    """
+    Return the resolved managed values and the placeholder regex. They are meant to be computed once and passed to
+    all the templates rendered with the same values
+    """
+    values_d = resolve_managed_values(info_d["managed_values"], get_version_str(info_d["version"]))
+    return values_d, get_placeholder_regex(values_d)
+
+
+def get_placeholder_regex(keys):
+    """Compile a regex matching any of the placeholder keys, longest keys first"""
+    keys = sorted(set(keys), key=len, reverse=True)
+    return re.compile("({})".format("|".join(re.escape(k) for k in keys)))
+
+
+def tokenize_template(s, regex):
+    """Split a template string into a list alternating literal strings and placeholder keys"""
+    return regex.split(s)
+
+
+def render_tokens(tokens, values_d):
+    """Render a tokenized template by substituting placeholder keys with their values in a single pass"""
+    l = list(tokens)
+    l[1::2] = [values_d[k] for k in tokens[1::2]]
+    return "".join(l)
+
+
+def render_matrix_file(src_fn, dest_fn, variant_list, regex, output_dir):
+    """Tokenize a template once and render it for all the variants in their own output directory"""
+    try:
+        with open(src_fn, "r") as src_fp:
+            tokens = tokenize_template(src_fp.read(), regex)
+    except:
+        raise IOError("Cannot read source Template file: {}".format(src_fn))
+
+    out_fn_list = []
+    for name, values_d in variant_list:
+        out_fn = os.path.join(output_dir, name, dest_fn)
+        mkbasedir(out_fn)
+        with open(out_fn, "w") as out_fp:
+            out_fp.write(render_tokens(tokens, values_d))
+        out_fn_list.append(out_fn)
+    return out_fn_list
+
+
+def stage_managed_file(src_fn, dest_fn, render_values, transaction, render_cache=None):
+    """Render a template and stage it in transaction, reusing the rendered file from render_cache if available"""
+    if render_cache is None:
+        transaction.write(dest_fn, render_template(src_fn, render_values))
+        return
+
+    # Templates are read the same way with or without cache, and cache entries are written in text mode like the
+    # staged files, so that the rendered bytes do not depend on the cache
+    template_s = read_template(src_fn)
+    key = render_cache.get_key(template_s.encode())
+    cached_fn = render_cache.get(key)
+    if cached_fn:
+        transaction.copy(dest_fn, cached_fn)
+    else:
+        s = render_string(template_s, render_values)
+        render_cache.put(key, s)
+        transaction.write(dest_fn, s)
+
+
+def update_managed_files(
+    info_d,
+    overwrite,
+    dry,
+    log,
+    dry_json=False,
+    threads=4,
+    transaction=None,
+    pipeline=False,
+    render_cache=None,
+    changes=None,
+):
+    """
+    Render managed files and stage them in transaction. If no transaction is given, the files are committed at once.
+    With pipeline, files are rendered and staged concurrently by an asyncio pipeline. If a render_cache is given,
+    previously rendered files are reused. In dry mode, the changes are collected in the changes list if given
+    """
+    if dry:
+        dry_run_managed_files(info_d=info_d, dry_json=dry_json, threads=threads, log=log, changes=changes)
+        return
+
+    local_transaction = transaction is None
+    if local_transaction:
+        transaction = FileTransaction(log=log)
+    render_values = get_render_values(info_d)
+    if render_cache:
+        render_cache.set_values(render_values[0])
+
+    # Ask for confirmation first, as prompts cannot be interleaved
+    file_list = []
+    for src_fn, dest_fn in get_managed_files(info_d, log=log).items():
+        if not overwrite and os.path.isfile(dest_fn):
+            choice = choose_option(choices=["y", "n"], message="Overwrite existing file {} ?".format(dest_fn))
+            if choice == "n":
+                log.debug("File {} was skipped".format(dest_fn))
+                transaction.skipped.append(dest_fn)
+                continue
+        file_list.append((src_fn, dest_fn))
+
+    try:
+        if pipeline:
+            loop = asyncio.new_event_loop()
             try:
-                src_fp = open(src_fn, "r")
-            except:
-                raise IOError("Cannot read source Template file: {}".format(src_fn))
+                loop.run_until_complete(
+                    stage_managed_files_async(
+                        file_list=file_list,
+                        render_values=render_values,
+                        transaction=transaction,
+                        threads=threads,
+                        render_cache=render_cache,
+                        log=log,
+                    )
+                )
+            finally:
+                loop.close()
+        else:
+            for src_fn, dest_fn in file_list:
+                log.debug("Updating file {}".format(dest_fn))
+                stage_managed_file(src_fn, dest_fn, render_values, transaction, render_cache)
+    except:
+        transaction.rollback()
+        raise
 
-            # Open destination file for writing
-            if not dry:
-                try:
-                    if not overwrite and os.path.isfile(dest_fn):
-                        choice = choose_option(
-                            choices=["y", "n"], message="Overwrite existing file {} ?".format(dest_fn)
-                        )
-                        if choice == "n":
-                            log.debug("File {dest_fn} was skipped")
-                            continue
-                    dest_fp = open(dest_fn, "w")
-                except:
-                    raise IOError("Cannot write to destination file: {}".format(dest_fn))
-
-            s = src_fp.read()
-            s = s.replace("__package_version__", version_str)
-            for k, v in info_d["managed_values"].items():
-                s = s.replace(k, v)
+    if local_transaction:
+        transaction.commit()
 
-            if dry:
-                stdout_print(s)
+
+async def stage_managed_files_async(file_list, render_values, transaction, threads, log, render_cache=None):
+    """Render and stage files concurrently, each file being staged as soon as it is rendered"""
+    loop = asyncio.get_event_loop()
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+
+        async def stage(src_fn, dest_fn):
+            await loop.run_in_executor(
+                executor, stage_managed_file, src_fn, dest_fn, render_values, transaction, render_cache
+            )
+            log.debug("File {} staged".format(dest_fn))
+
+        await asyncio.gather(*[stage(src_fn, dest_fn) for src_fn, dest_fn in file_list])
+
+
+def dry_run_managed_files(info_d, dry_json, threads, log, changes=None):
+    """
+    Compute the change set of the managed files without writing them. Changed files are streamed to stdout as soon as
+    they are rendered, either as a short human readable summary with a compact diff or as JSON lines, or collected in
+    the changes list if given
+    """
+    n_changed = 0
+    render_values = get_render_values(info_d)
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        futures = [
+            executor.submit(
+                diff_managed_file, src_fn=src_fn, dest_fn=dest_fn, render_values=render_values, diff=True, context=1
+            )
+            for src_fn, dest_fn in get_managed_files(info_d, log=log).items()
+        ]
+        for future in as_completed(futures):
+            d = future.result()
+            if d["status"] == "unchanged":
+                log.debug("File {} would not change".format(d["file"]))
+                continue
+            n_changed += 1
+            if changes is not None:
+                changes.append(d)
+            elif dry_json:
+                stdout_print(json.dumps(d) + "\n")
             else:
-                dest_fp.write(s)
+                stdout_print("{} {} ({:+,} bytes)\n".format(d["status"], d["file"], d["delta"]))
+                stdout_print("".join(d["diff"]))
 
-        finally:
-            # Try to close file pointers
-            for fp, fn in [[src_fp, src_fn], [dest_fp, dest_fn]]:
-                if fp:
-                    try:
-                        fp.close()
-                    except:
-                        pass
+    log.info("{} managed file(s) would be changed".format(n_changed))
+    return n_changed
 
 
-def update_versipy_files(info_d, versipy_fn, versipy_history_fn, comment, overwrite, dry, log):
-    """"""
+def file_hash(fn, chunk_size=1048576):
+    """Compute the sha1 hex digest of a file by chunks"""
+    h = hashlib.sha1()
+    with open(fn, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_stat_signature(fn):
+    """Cheap file signature (mtime in ns and size) or None if the file does not exist"""
+    try:
+        st = os.stat(fn)
+        return [st.st_mtime_ns, st.st_size]
+    except OSError:
+        return None
+
+
+def load_cache(cache_fn):
+    """Load versipy JSON cache file. Return an empty dict if the file is missing or not valid"""
+    try:
+        with open(cache_fn, "r") as fp:
+            d = json.load(fp)
+        return d if isinstance(d, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def dump_cache(d, cache_fn):
+    """Write versipy JSON cache file atomically. Failing to write the cache is not an error"""
+    try:
+        fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_fn)), suffix=".tmp")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(d, fp)
+        os.replace(tmp_fn, cache_fn)
+    except OSError:
+        pass
+
+
+def is_pattern_mapping(src_fn):
+    """Managed file keys containing glob characters or pointing to a directory are expanded into several files"""
+    return any(c in src_fn for c in "*?[") or src_fn.endswith("/") or os.path.isdir(src_fn)
+
+
+def glob_to_regex(pattern):
+    """Translate a glob pattern into a regex. `**` matches any number of directories, `*` and `?` do not match `/`"""
+    i, n = 0, len(pattern)
+    res = ""
+    while i < n:
+        if pattern.startswith("**/", i):
+            res += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            res += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            res += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            res += "[^/]"
+            i += 1
+        elif pattern[i] == "[":
+            # Like fnmatch, only a leading `!` negates and a `]` right after it or after `[` is a literal
+            j = i + 1
+            if pattern.startswith("!", j):
+                j += 1
+            if pattern.startswith("]", j):
+                j += 1
+            j = pattern.find("]", j)
+            if j == -1:
+                res += re.escape("[")
+                i += 1
+                continue
+            chars = pattern[i + 1 : j]
+            negate = chars.startswith("!")
+            chars = re.sub(r"([\\^\[\]])", r"\\\1", chars[1:] if negate else chars)
+            res += "[^/" + chars + "]" if negate else "[" + chars + "]"
+            i = j + 1
+        else:
+            res += re.escape(pattern[i])
+            i += 1
+    return re.compile(res + "$")
+
+
+def split_pattern(src_fn):
+    """Split a pattern mapping into the base directory to walk and the glob pattern relative to it"""
+    src_fn = src_fn.replace(os.sep, "/")
+    if not any(c in src_fn for c in "*?["):
+        return src_fn.rstrip("/") or ".", "**"
+    base_l = []
+    parts = src_fn.split("/")
+    for i, part in enumerate(parts):
+        if any(c in part for c in "*?["):
+            return "/".join(base_l) or ".", "/".join(parts[i:])
+        base_l.append(part)
+
+
+def scandir_walk(dir_fn, dir_mtimes):
+    """Recursively list files with os.scandir, recording the mtime of every walked directory in dir_mtimes"""
+    try:
+        dir_mtimes[dir_fn] = os.stat(dir_fn).st_mtime_ns
+        with os.scandir(dir_fn) as it:
+            entries = list(it)
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from scandir_walk(entry.path, dir_mtimes)
+        elif entry.is_file():
+            yield entry.path
+
+
+def expand_pattern(src_fn, dest_fn, cache_d=None):
+    """
+    Expand a glob or directory mapping in a list of (template, destination) pairs. The destination is treated as a
+    directory in which files are written following their path relative to the base directory of the pattern. If
+    cache_d is given, the expansion is reused as long as none of the walked directories was modified. Expansions of
+    missing base directories are never cached, as there is no directory to watch for new files
+    """
+    if cache_d is not None:
+        entry = cache_d.get(src_fn)
+        if entry and entry["dest"] == dest_fn and entry["dirs"]:
+            if all((file_stat_signature(d) or [None])[0] == m for d, m in entry["dirs"].items()):
+                return [tuple(l) for l in entry["files"]]
+
+    base_fn, pattern = split_pattern(src_fn)
+    regex = glob_to_regex(pattern)
+    dir_mtimes = OrderedDict()
+    file_list = []
+    for fn in scandir_walk(base_fn, dir_mtimes):
+        rel_fn = os.path.relpath(fn, base_fn).replace(os.sep, "/")
+        if regex.match(rel_fn):
+            file_list.append((os.path.normpath(fn), os.path.normpath(os.path.join(dest_fn, rel_fn))))
+    file_list.sort()
+
+    if cache_d is not None:
+        if base_fn in dir_mtimes:
+            cache_d[src_fn] = OrderedDict([("dest", dest_fn), ("dirs", dir_mtimes), ("files", file_list)])
+        else:
+            cache_d.pop(src_fn, None)
+    return file_list
+
+
+def get_managed_files(info_d, log, cache_fn=".versipy_cache.json"):
+    """
+    Return an ordered dict of template to destination files, in which glob and directory mappings of the
+    managed_files section are expanded. Expansions are cached in cache_fn between runs (empty to disable). Raise a
+    ValueError if a template is matched by several entries
+    """
+    if not any(is_pattern_mapping(src_fn) for src_fn in info_d["managed_files"]):
+        return OrderedDict(info_d["managed_files"])
+
+    cache_d = load_cache(cache_fn) if cache_fn else {}
+    expand_cache_d = cache_d.get("managed_files", {})
+    modified = False
+    for src_fn in list(expand_cache_d):
+        if src_fn not in info_d["managed_files"]:
+            del expand_cache_d[src_fn]
+            modified = True
+
+    files_d = OrderedDict()
+    for src_fn, dest_fn in info_d["managed_files"].items():
+        if is_pattern_mapping(src_fn):
+            entry = expand_cache_d.get(src_fn)
+            file_list = expand_pattern(src_fn, dest_fn, expand_cache_d)
+            modified |= expand_cache_d.get(src_fn) is not entry
+            log.debug("Pattern {} expanded to {} file(s)".format(src_fn, len(file_list)))
+        else:
+            file_list = [(src_fn, dest_fn)]
+        for fn, dest in file_list:
+            if fn in files_d:
+                raise ValueError(
+                    "Template {} is matched by several managed_files entries (destinations {} and {})".format(
+                        fn, files_d[fn], dest
+                    )
+                )
+            files_d[fn] = dest
+
+    if cache_fn and modified:
+        cache_d["managed_files"] = expand_cache_d
+        dump_cache(cache_d, cache_fn)
+    return files_d
+
+
+def diff_managed_file(src_fn, dest_fn, render_values, diff=False, context=3):
+    """
+    Render a template in memory and compare it with the destination file.
+    Return a dict describing the change status, the size difference and optionally a unified diff. New files get no
+    diff, as it would be their whole content
+    """
+    s = render_template(src_fn, render_values)
+    new_b = s.encode()
+    d = OrderedDict()
+    d["file"] = dest_fn
+    d["old_size"] = 0
+    d["new_size"] = len(new_b)
+
+    if not os.path.isfile(dest_fn):
+        d["status"] = "new"
+    else:
+        d["old_size"] = os.path.getsize(dest_fn)
+        if d["old_size"] == d["new_size"] and file_hash(dest_fn) == hashlib.sha1(new_b).hexdigest():
+            d["status"] = "unchanged"
+        else:
+            d["status"] = "modified"
+
+    d["delta"] = d["new_size"] - d["old_size"]
+    d["diff"] = []
+    if diff and d["status"] == "modified":
+        with open(dest_fn, "r") as fp:
+            old_s = fp.read()
+        d["diff"] = list(
+            difflib.unified_diff(
+                old_s.splitlines(keepends=True),
+                s.splitlines(keepends=True),
+                fromfile="{} (current)".format(dest_fn),
+                tofile="{} (rendered)".format(dest_fn),
+                n=context,
+            )
+        )
+    return d
+
+
+class RenderCache:
+    """
+    Content addressed cache of rendered files stored in a local directory, that can be shared between runs and CI jobs.
+    Entries are keyed by the hash of the template content, managed values and version, and evicted in least recently
+    used order when the total cache size exceeds max_size (in MB)
+    """
+
+    def __init__(self, cache_dir, log, max_size=512):
+        self.cache_dir = cache_dir
+        self.log = log
+        self.max_size = max_size * 1024 * 1024
+        self._values_hash = None
+        self.hits = self.misses = 0
+        mkdir(cache_dir, exist_ok=True)
+
+    def set_values(self, values_d):
+        """Hash the resolved managed values once for all the templates rendered with them"""
+        values_s = json.dumps(list(values_d.items()))
+        self._values_hash = hashlib.sha256(values_s.encode()).hexdigest()
+
+    def get_key(self, template_b):
+        """Compute the cache key of a template content"""
+        h = hashlib.sha256(template_b)
+        h.update(self._values_hash.encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        """Return the path of the cached rendered file or None. Hits are touched to maintain the LRU order"""
+        fn = self._path(key)
+        try:
+            os.utime(fn)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return fn
+
+    def put(self, key, s):
+        """Atomically add a rendered file to the cache"""
+        fn = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), suffix=".tmp")
+            with os.fdopen(fd, "w") as fp:
+                fp.write(s)
+            os.chmod(tmp_fn, 0o644)
+            os.replace(tmp_fn, fn)
+        except OSError as E:
+            self.log.debug("Cannot write render cache entry {}: {}".format(fn, E))
+
+    def evict(self):
+        """Remove the least recently used entries until the cache size is below max_size"""
+        entries = []
+        for fn in scandir_walk(self.cache_dir, {}):
+            try:
+                st = os.stat(fn)
+                entries.append((st.st_mtime_ns, st.st_size, fn))
+            except OSError:
+                pass
+        total = sum(size for _, size, _ in entries)
+        n_evicted = 0
+        for _, size, fn in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(fn)
+                total -= size
+                n_evicted += 1
+            except OSError:
+                pass
+        self.log.debug(
+            "Render cache: {} hit(s), {} miss(es), {} evicted entries".format(self.hits, self.misses, n_evicted)
+        )
+
+
+def update_versipy_files(info_d, versipy_fn, versipy_history_fn, comment, overwrite, dry, log, transaction=None):
+    """
+    Stage versipy YAML and history files in transaction. If no transaction is given, the files are committed at once
+    """
     version_str = get_version_str(info_d["version"])
     if not dry:
         choice = "y"
@@ -531,12 +1271,349 @@ def update_versipy_files(info_d, versipy_fn, versipy_history_fn, comment, overwr
             choice = choose_option(choices=["y", "n"], message="Overwrite existing versipy files?")
         if choice == "n":
             log.debug("Versipy files were not updated")
+            if transaction is not None:
+                transaction.skipped.extend([versipy_fn, versipy_history_fn])
         elif choice == "y":
-            log.debug("Updating versipy template yaml file")
-            ordered_dump_yaml(info_d, versipy_fn, Dumper=yaml.Dumper)
-            log.debug("Updating versipy history file")
-            with open(versipy_history_fn, "a") as fp:
-                fp.write("{}\t{}\t{}\n".format(datetime.datetime.now(), version_str, comment))
+            local_transaction = transaction is None
+            if local_transaction:
+                transaction = FileTransaction(log=log)
+            try:
+                log.debug("Updating versipy template yaml file")
+                transaction.write(versipy_fn, ordered_yaml_str(info_d, Dumper=yaml.Dumper))
+                log.debug("Updating versipy history file")
+                transaction.append(
+                    versipy_history_fn, "{}\t{}\t{}\n".format(datetime.datetime.now(), version_str, comment)
+                )
+            except:
+                transaction.rollback()
+                raise
+            if local_transaction:
+                transaction.commit()
+
+
+def update_gitignore(pattern_list, transaction, log, gitignore_fn=".gitignore"):
+    """Stage the patterns of pattern_list that are missing from the gitignore file at the end of it"""
+    old_s = ""
+    if os.path.isfile(gitignore_fn):
+        with open(gitignore_fn, "r") as fp:
+            old_s = fp.read()
+    missing_list = [p for p in pattern_list if p not in old_s.splitlines()]
+    if missing_list:
+        log.debug("Adding {} to {}".format(", ".join(missing_list), gitignore_fn))
+        sep = "\n" if old_s and not old_s.endswith("\n") else ""
+        transaction.append(gitignore_fn, sep + "".join(p + "\n" for p in missing_list))
+
+
+def update_version(
+    version_func,
+    versipy_fn,
+    versipy_history_fn,
+    comment,
+    overwrite,
+    dry,
+    log,
+    dry_json=False,
+    threads=4,
+    lock=False,
+    optimistic=False,
+    retries=10,
+    pipeline=False,
+    transaction=None,
+    render_cache=None,
+    changes=None,
+):
+    """
+    Load the versipy YAML file, compute the new version with version_func and update the managed and versipy files.
+    With lock, the whole load > update > write cycle holds an advisory lock on the versipy file. With optimistic, files
+    are rendered without lock and the lock is only held to check that the versipy file was not modified concurrently
+    before committing. In case of conflict the staged files are discarded and the cycle is retried.
+    Return the updated info dict, the previous and new version strings
+    """
+    if transaction is None:
+        transaction = FileTransaction(log=log)
+
+    for attempt in range(retries + 1):
+        with ExitStack() as stack:
+            # Hold the lock for the full cycle in pessimistic mode
+            if lock and not optimistic and not dry:
+                stack.enter_context(FileLock(versipy_fn, log=log))
+
+            # Load and check file. Hash first, so that a concurrent change can only cause a spurious retry
+            versipy_hash = file_hash(versipy_fn)
+            info_d = get_versipy_yaml(versipy_fn=versipy_fn, log=log)
+            previous_version_str = get_version_str(info_d["version"])
+            info_d["version"] = version_func(info_d["version"])
+            version_str = get_version_str(info_d["version"])
+
+            log.info("Update managed files")
+            update_managed_files(
+                info_d=info_d,
+                overwrite=overwrite,
+                dry=dry,
+                dry_json=dry_json,
+                threads=threads,
+                transaction=transaction,
+                pipeline=pipeline,
+                render_cache=render_cache,
+                changes=changes,
+                log=log,
+            )
+            update_versipy_files(
+                info_d=info_d,
+                versipy_fn=versipy_fn,
+                versipy_history_fn=versipy_history_fn,
+                comment=comment,
+                overwrite=overwrite,
+                dry=dry,
+                transaction=transaction,
+                log=log,
+            )
+            if dry:
+                return info_d, previous_version_str, version_str
+
+            if not optimistic:
+                log.info("Commit file changes")
+                transaction.commit()
+                return info_d, previous_version_str, version_str
+
+            with FileLock(versipy_fn, log=log):
+                if file_hash(versipy_fn) == versipy_hash:
+                    log.info("Commit file changes")
+                    transaction.commit()
+                    return info_d, previous_version_str, version_str
+            transaction.rollback()
+
+        # Randomised exponential backoff before retrying
+        log.info("Versipy file modified concurrently, retrying ({}/{})".format(attempt + 1, retries))
+        time.sleep(random.uniform(0, min(0.01 * 2 ** attempt, 1)))
+
+    raise IOError("Versipy file {} modified concurrently, giving up after {} retries".format(versipy_fn, retries))
+
+
+def iter_reverse_lines(fn, chunk_size=65536):
+    """Iterate over the non empty lines of a file starting from the end, reading it by chunks"""
+    with open(fn, "rb") as fp:
+        fp.seek(0, os.SEEK_END)
+        pos = fp.tell()
+        rest = b""
+        while pos > 0:
+            step = min(chunk_size, pos)
+            pos -= step
+            fp.seek(pos)
+            lines = (fp.read(step) + rest).split(b"\n")
+            rest = lines.pop(0)
+            for l in reversed(lines):
+                if l:
+                    yield l.decode()
+        if rest:
+            yield rest.decode()
+
+
+def get_history_versions(versipy_history_fn, n=2):
+    """Return the versions of the last n entries of the versipy history file, reading it from the end"""
+    version_list = []
+    try:
+        for l in iter_reverse_lines(versipy_history_fn):
+            l = l.split("\t")
+            if len(l) >= 2:
+                version_list.insert(0, l[1])
+                if len(version_list) == n:
+                    break
+    except OSError:
+        raise IOError("Cannot read versipy history file: {}".format(versipy_history_fn))
+    return version_list
+
+
+def parse_history_line(l):
+    """Parse a versipy history line in a (timestamp, version, comment) tuple, or None if not valid"""
+    l = l.rstrip("\n").split("\t", 2)
+    if len(l) < 2:
+        return None
+    for fmt in ["%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"]:
+        try:
+            ts = datetime.datetime.strptime(l[0], fmt).timestamp()
+            return (ts, l[1], l[2] if len(l) == 3 else "")
+        except ValueError:
+            pass
+    return None
+
+
+def get_history_range(versipy_history_fn, from_version="", to_version=""):
+    """
+    Find the history entries after from_version and up to to_version by scanning the history file from the end, so
+    that only the lines after from_version are read. The most recent entries of the versions are used. Defaults to the
+    last entry and the entry preceding it. Return the from_version entry and the list of entries in chronological order
+    """
+    entries = []
+    try:
+        for l in iter_reverse_lines(versipy_history_fn):
+            e = parse_history_line(l)
+            if not e:
+                continue
+            if not entries:
+                if not to_version or e[1] == to_version:
+                    entries.append(e)
+            elif (from_version and e[1] == from_version) or (not from_version and e[1] != entries[-1][1]):
+                return e, entries[::-1]
+            else:
+                entries.append(e)
+    except OSError:
+        raise IOError("Cannot read versipy history file: {}".format(versipy_history_fn))
+
+    if not entries:
+        raise ValueError("Version {} not found in history file {}".format(to_version, versipy_history_fn))
+    raise ValueError("Version {} not found before {} in history file".format(from_version, entries[0][1]))
+
+
+def iter_git_log(since_ts, until_ts):
+    """Stream (short hash, timestamp, author, subject) of the commits in a time interval from a single git process"""
+    since = datetime.datetime.utcfromtimestamp(since_ts).strftime("%Y-%m-%dT%H:%M:%SZ")
+    until = datetime.datetime.utcfromtimestamp(until_ts).strftime("%Y-%m-%dT%H:%M:%SZ")
+    cmd = ["git", "log", "--format=%h%x1f%ct%x1f%an%x1f%s", "--since={}".format(since), "--until={}".format(until)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    for l in proc.stdout:
+        l = l.rstrip("\n").split("\x1f", 3)
+        if len(l) == 4:
+            yield l[0], int(l[1]), l[2], l[3]
+    stderr = proc.stderr.read()
+    if proc.wait() != 0:
+        raise IOError("git log failed: {}".format(stderr.strip()))
+
+
+def group_commits_by_version(from_entry, entries, grace=300):
+    """
+    Assign commits to the first version recorded in the history after them. History timestamps are rounded down to
+    whole seconds like git commit times, so that commits made in the same second as a history entry are considered to
+    follow it. The commit created by versipy just after a version change, identified by its subject being the history
+    comment, is assigned to this version if it was committed within a grace period in seconds. Only the first such
+    commit is assigned to each version. Grouping relies on commit times, so commits from merged branches are assigned
+    to the version following their original commit time rather than their merge time
+    """
+    all_entries = [from_entry] + entries
+    bounds = [int(e[0]) for e in all_entries]
+    groups = [[] for _ in all_entries]
+    bumped = set()
+    for commit in reversed(list(iter_git_log(bounds[0], bounds[-1] + grace))):
+        i = bisect.bisect_right(bounds, commit[1])
+        if i > 0 and i - 1 not in bumped and commit[1] - bounds[i - 1] <= grace and commit[3] == all_entries[i - 1][2]:
+            i -= 1
+            bumped.add(i)
+        if 0 < i < len(groups):
+            groups[i].append(commit)
+    return [g[::-1] for g in groups[1:]]
+
+
+def changelog_markdown(from_entry, entries, groups):
+    """Format commits grouped by version in Markdown, most recent versions first"""
+    l = ["# Changelog {} > {}\n".format(from_entry[1], entries[-1][1])]
+    for (ts, version, comment), commits in reversed(list(zip(entries, groups))):
+        l.append("\n## {} ({})\n\n".format(version, datetime.datetime.fromtimestamp(ts).strftime("%Y-%m-%d")))
+        if comment:
+            l.append("*{}*\n\n".format(comment))
+        for hexsha, _, author, subject in commits:
+            l.append("- {} ({}, {})\n".format(subject, hexsha, author))
+    return "".join(l)
+
+
+def list_repo_files(log, exclude=[]):
+    """List the files of the working tree honoring .gitignore rules. Fall back to a directory walk outside of git"""
+    exclude = set(os.path.normpath(fn) for fn in exclude)
+    try:
+        repo = Repo()
+        log.debug("List files tracked or not ignored by git")
+        fn_list = repo.git.ls_files("--cached", "--others", "--exclude-standard", "-z").split("\0")
+        fn_list = [os.path.join(repo.working_tree_dir, fn) for fn in fn_list if fn]
+        fn_list = [os.path.relpath(fn) for fn in fn_list]
+    except InvalidGitRepositoryError:
+        log.debug("Not a git repository, list all files")
+        fn_list = []
+        for root, dirs, files in os.walk("."):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            fn_list.extend(os.path.relpath(os.path.join(root, fn)) for fn in files)
+
+    return [fn for fn in fn_list if fn not in exclude and os.path.isfile(fn)]
+
+
+def get_version_regex(version_str):
+    """Compile a bytes regex matching a version string not embedded in a longer version string"""
+    return re.compile(b"(?<![0-9.])" + re.escape(version_str.encode()) + b"(?![0-9A-Za-z]|\\.[0-9A-Za-z])")
+
+
+def scan_file(fn, regex):
+    """Find all matches of a bytes regex in a file using a memory map. Binary files are skipped"""
+    hits = []
+    try:
+        with open(fn, "rb") as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return hits
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm.find(b"\0", 0, 8192) != -1:
+                    return hits
+                line_num = 1
+                last_pos = 0
+                for m in regex.finditer(mm):
+                    line_num += mm[last_pos : m.start()].count(b"\n")
+                    last_pos = m.start()
+                    line_start = mm.rfind(b"\n", 0, m.start()) + 1
+                    line_end = mm.find(b"\n", m.start())
+                    if line_end == -1:
+                        line_end = len(mm)
+                    line = mm[line_start:line_end].decode(errors="replace").strip()
+                    hits.append((fn, line_num, m.start() - line_start + 1, line))
+    except (OSError, ValueError):
+        pass
+    return hits
+
+
+def read_manifest(manifest_fn):
+    """
+    Read a manifest mapping project paths to a target version or bump levels, either from a YAML mapping or from a
+    CSV file with 2 columns (lines starting with # are ignored)
+    """
+    if manifest_fn.endswith(".csv"):
+        manifest_d = OrderedDict()
+        try:
+            with open(manifest_fn, "r", newline="") as fp:
+                for row in csv.reader(fp):
+                    if not row or row[0].strip().startswith("#"):
+                        continue
+                    if len(row) != 2:
+                        raise ValueError("Invalid manifest line: {}".format(",".join(row)))
+                    manifest_d[row[0].strip()] = row[1].strip()
+        except OSError:
+            raise IOError("Cannot read manifest file: {}".format(manifest_fn))
+    else:
+        # Load all scalars as strings, so that versions like 1.10 are not read as floats
+        manifest_d = ordered_load_yaml(manifest_fn, Loader=yaml.BaseLoader)
+        if not isinstance(manifest_d, dict):
+            raise ValueError("Manifest must map project paths to versions: {}".format(manifest_fn))
+    return OrderedDict((str(k), str(v)) for k, v in manifest_d.items())
+
+
+def get_target_version(version_d, target, log):
+    """
+    Compute a new version dict from a target that can either be a PEP canonical version string or a comma separated
+    list of levels to increment (major, minor, micro, alpha, beta, rc, post, dev)
+    """
+    if is_canonical_version(target):
+        return parse_version_str(version_str=target, log=log)
+
+    level_d = dict(major="major", minor="minor", micro="micro", alpha="a", beta="b", rc="rc", post="post", dev="dev")
+    levels = [l.strip() for l in target.split(",") if l.strip()]
+    invalid = [l for l in levels if l not in level_d]
+    if not levels or invalid:
+        raise ValueError("Invalid target '{}': not a PEP canonical version nor valid bump levels".format(target))
+    return increment_version(version_d=version_d, log=log, **{level_d[l]: True for l in levels})
+
+
+def prefix_managed_files(info_d, project_dir):
+    """Return a shallow copy of info_d with template and destination paths relative to project_dir"""
+    prefixed_d = OrderedDict(info_d)
+    prefixed_d["managed_files"] = OrderedDict(
+        (os.path.join(project_dir, src_fn), os.path.join(project_dir, dest_fn))
+        for src_fn, dest_fn in info_d["managed_files"].items()
+    )
+    return prefixed_d
 
 
 def get_versipy_yaml_template():
@@ -588,7 +1665,8 @@ def write_versipy_yaml(versipy_fn, overwrite, log):
 
 
 def git_files(files, version, comment, git_tag, log):
-    """"""
+    """Add, commit and push files, then optionally tag. Return a dict with the commit, the tags and the push status"""
+    res = OrderedDict([("commit", None), ("tags", []), ("pushed", False), ("error", None)])
     try:
         log.debug("Acquire local repository")
         repo = Repo()
@@ -598,13 +1676,368 @@ def git_files(files, version, comment, git_tag, log):
         for f in files:
             repo.index.add(f)
         commit = repo.index.commit(message=comment)
-        push = remote.push()
+        res["commit"] = commit.hexsha
+        check_push_infos(remote.push())
 
         if git_tag:
             log.debug("Set and push new version tag")
             tag = repo.create_tag(version, message=comment)
-            push = remote.push(tag)
+            res["tags"].append(tag.name)
+            check_push_infos(remote.push(tag))
+        res["pushed"] = True
 
     except Exception as E:
         log.info("Failed to push to remote")
-        log.debug(type(E), str(E))
+        log.debug("{}: {}".format(type(E).__name__, E))
+        res["error"] = str(E)
+    return res
+
+
+def check_push_infos(push_infos):
+    """Raise an IOError if any ref was not pushed, since GitPython does not raise on rejected pushes"""
+    for info in push_infos:
+        if info.flags & (info.ERROR | info.REJECTED | info.REMOTE_REJECTED | info.REMOTE_FAILURE):
+            raise IOError("Failed to push {}: {}".format(info.local_ref, info.summary.strip()))
+
+
+class GitPushProgress(RemoteProgress):
+    """Report git push progress through the logger"""
+
+    def __init__(self, log):
+        super().__init__()
+        self.log = log
+
+    def update(self, op_code, cur_count, max_count=None, message=""):
+        if op_code & self.END:
+            self.log.info("Push: {}".format(self._cur_line))
+        else:
+            self.log.debug("Push: {}".format(self._cur_line))
+
+
+def get_git_odb(log):
+    """Return the git object database of the current repository or None outside of a git repository"""
+    try:
+        return Repo().odb
+    except Exception as E:
+        log.debug("Cannot access git repository: {}".format(E))
+        return None
+
+
+def git_blobs(blob_d, comment, tags, log):
+    """
+    Add files to the git index from their precomputed blobs, commit, create the tags, and push the branch and the tags
+    together in the background while reporting progress. Return a dict with the commit, the tags and the push status,
+    in which the commit and the tags created before a failure are kept
+    """
+    res = OrderedDict([("commit", None), ("tags", []), ("pushed", False), ("error", None)])
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(git_blobs_async(blob_d=blob_d, comment=comment, tags=tags, log=log, res=res))
+    except Exception as E:
+        log.info("Failed to push to remote")
+        log.debug("{}: {}".format(type(E).__name__, E))
+        res["error"] = str(E)
+    finally:
+        loop.close()
+    return res
+
+
+async def git_blobs_async(blob_d, comment, tags, log, res):
+    """Coroutine doing the work of git_blobs and filling res as it goes"""
+    loop = asyncio.get_event_loop()
+    log.debug("Acquire local repository")
+    repo = Repo()
+    remote = repo.remote("origin")
+
+    log.debug("Add files to index from staged blobs")
+    entries = []
+    for fn, binsha in blob_d.items():
+        path = os.path.relpath(os.path.abspath(fn), repo.working_tree_dir).replace(os.sep, "/")
+        entries.append(BaseIndexEntry((stat_mode_to_index_mode(os.stat(fn).st_mode), binsha, 0, path)))
+    repo.index.add(entries)
+    commit = repo.index.commit(message=comment)
+    res["commit"] = commit.hexsha
+
+    refspecs = []
+    for tag in tags:
+        log.debug("Set new version tag {}".format(tag))
+        repo.create_tag(tag, message=comment)
+        res["tags"].append(tag)
+        refspecs.append("refs/tags/{0}:refs/tags/{0}".format(tag))
+
+    refspecs.insert(0, repo.active_branch.name)
+    log.debug("Push {} to remote in the background".format(", ".join(refspecs)))
+    start = time.time()
+    push = loop.run_in_executor(None, lambda: remote.push(refspecs, progress=GitPushProgress(log)))
+    while True:
+        done, _ = await asyncio.wait([push], timeout=1)
+        if done:
+            break
+        log.info("Pushing to remote... ({:.0f}s)".format(time.time() - start))
+    check_push_infos(push.result())
+    log.info("Pushed to remote in {:.2f}s".format(time.time() - start))
+    res["pushed"] = True
+
+
+# VERSION SERVER #######################################################################################################
+
+
+class AllocationBatch:
+    """Versions allocated since the last group commit, with an event set once they are committed or failed"""
+
+    def __init__(self):
+        self.lines = []
+        self.done = threading.Event()
+        self.error = None
+
+
+class VersionAllocator:
+    """
+    Hold the project version in memory and allocate monotonically increasing post or dev versions. Allocations are
+    grouped in batches written to the versipy and history files by group commits with flush, and are only returned to
+    the caller once their batch is committed. A group commit fails instead of overwriting the versipy file if it was
+    modified by another process since it was loaded, in which case the allocator restarts from the file on disk.
+    """
+
+    levels = ["post", "dev"]
+
+    def __init__(self, versipy_fn, versipy_history_fn, comment, log):
+        self.versipy_fn = versipy_fn
+        self.versipy_history_fn = versipy_history_fn
+        self.comment = comment
+        self.log = log
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.has_pending = threading.Event()
+        self.batch = AllocationBatch()
+        self.n_allocated = 0
+        self.load()
+
+    def load(self):
+        """(Re)load the versipy file and record its hash to detect concurrent modifications"""
+        with FileLock(self.versipy_fn, log=self.log):
+            self.versipy_hash = file_hash(self.versipy_fn)
+            self.info_d = get_versipy_yaml(versipy_fn=self.versipy_fn, log=self.log)
+        self.version_str = get_version_str(self.info_d["version"])
+
+    def current(self):
+        with self.lock:
+            return self.version_str
+
+    def allocate(self, level="dev"):
+        """Increment the given level and return the new version string once it is committed"""
+        if not level in self.levels:
+            raise ValueError("Invalid level {}, must be one of {}".format(level, ", ".join(self.levels)))
+        with self.lock:
+            version_d = self.info_d["version"]
+            version_d[level] = 1 if version_d[level] is None else version_d[level] + 1
+            version_str = self.version_str = get_version_str(version_d)
+            batch = self.batch
+            batch.lines.append("{}\t{}\t{}\n".format(datetime.datetime.now(), version_str, self.comment))
+            self.has_pending.set()
+        batch.done.wait()
+        if batch.error:
+            raise IOError("Version {} was not committed: {}".format(version_str, batch.error))
+        return version_str
+
+    def flush(self):
+        """Group commit all pending allocations to the versipy YAML and history files"""
+        with self.flush_lock:
+            with self.lock:
+                batch = self.batch
+                if not batch.lines:
+                    return 0
+                info_d = copy.deepcopy(self.info_d)
+                self.batch = AllocationBatch()
+                self.has_pending.clear()
+
+            self.log.debug("Commit {} allocated version(s)".format(len(batch.lines)))
+            try:
+                with FileLock(self.versipy_fn, log=self.log):
+                    if file_hash(self.versipy_fn) != self.versipy_hash:
+                        raise IOError("Versipy file {} was modified by another process".format(self.versipy_fn))
+                    transaction = FileTransaction(log=self.log)
+                    transaction.write(self.versipy_fn, ordered_yaml_str(info_d, Dumper=yaml.Dumper))
+                    transaction.append(self.versipy_history_fn, "".join(batch.lines))
+                    transaction.commit()
+                    self.versipy_hash = file_hash(self.versipy_fn)
+            except Exception as E:
+                # Allocations made after this batch build on it: fail them too and restart from the file on disk
+                failed = [batch]
+                try:
+                    with self.lock:
+                        failed.append(self.batch)
+                        self.batch = AllocationBatch()
+                        self.has_pending.clear()
+                        self.load()
+                finally:
+                    for b in failed:
+                        b.error = str(E)
+                        b.done.set()
+                raise
+
+            with self.lock:
+                self.n_allocated += len(batch.lines)
+            batch.done.set()
+            return len(batch.lines)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def get_version_request_handler(allocator):
+    """Build a minimal HTTP request handler class bound to a VersionAllocator"""
+
+    class VersionRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def _reply(self, code, msg):
+            body = (msg + "\n").encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/current":
+                self._reply(200, allocator.current())
+            elif url.path == "/next":
+                level = parse_qs(url.query).get("level", ["dev"])[0]
+                try:
+                    self._reply(200, allocator.allocate(level))
+                except ValueError as E:
+                    self._reply(400, str(E))
+                except IOError as E:
+                    self._reply(503, str(E))
+            else:
+                msg = "Unknown endpoint {}. Valid endpoints: /current, /next?level=dev|post".format(url.path)
+                self._reply(404, msg)
+
+        do_POST = do_GET
+
+        def log_message(self, format, *args):
+            allocator.log.debug("{} {}".format(self.address_string(), format % args))
+
+    return VersionRequestHandler
+
+
+# SYNTHETIC PROJECTS ###################################################################################################
+
+
+def synthetic_text(rng, size, keys):
+    """Generate about size bytes of text lines, each containing a placeholder key picked at random"""
+    lines = []
+    n = 0
+    while n < size:
+        line = "line {} {} lorem ipsum dolor sit amet\n".format(len(lines), rng.choice(keys))
+        lines.append(line)
+        n += len(line)
+    return "".join(lines)
+
+
+def generate_synthetic_project(
+    project_dir,
+    n_files,
+    n_values,
+    file_size,
+    n_large_files,
+    large_file_size,
+    n_history,
+    git_remote,
+    log,
+    seed=42,
+):
+    """
+    Generate a synthetic versipy project with n_files small and n_large_files large templates, n_values managed values
+    (one in 10 referencing other values), a history file with n_history lines and optionally a git repository with a
+    local bare remote. Return the path of the remote or None
+    """
+    rng = random.Random(seed)
+    mkdir(project_dir)
+
+    log.debug("Generating managed values")
+    managed_values = OrderedDict()
+    managed_values["__package_name__"] = os.path.basename(os.path.abspath(project_dir))
+    for i in range(n_values):
+        if i and i % 10 == 0:
+            managed_values["__value_{}__".format(i)] = "__value_{}__-__package_version__".format(i - 1)
+        else:
+            managed_values["__value_{}__".format(i)] = "value {}".format(i)
+    keys = list(managed_values.keys()) + ["__package_version__"]
+
+    log.debug("Generating templates")
+    managed_files = OrderedDict()
+    for i in range(n_files):
+        src_fn = os.path.join("templates", "d{}".format(i // 100), "file_{}.txt".format(i))
+        managed_files[src_fn] = os.path.join("src", "d{}".format(i // 100), "file_{}.txt".format(i))
+    for i in range(n_large_files):
+        fn = "large_{}.txt".format(i)
+        managed_files[os.path.join("templates", fn)] = os.path.join("src", fn)
+    for i, src_fn in enumerate(managed_files):
+        size = file_size if i < n_files else large_file_size
+        os.makedirs(os.path.join(project_dir, os.path.dirname(src_fn)), exist_ok=True)
+        with open(os.path.join(project_dir, src_fn), "w") as fp:
+            fp.write(synthetic_text(rng, size, keys))
+
+    log.debug("Generating history")
+    start = datetime.datetime(2020, 1, 1)
+    with open(os.path.join(project_dir, "versipy_history.txt"), "w") as fp:
+        for i in range(n_history):
+            ts = start + datetime.timedelta(minutes=i)
+            fp.write("{}\t0.{}.{}\tSynthetic bump {}\n".format(ts, i // 1000, i % 1000, i))
+
+    info_d = OrderedDict()
+    info_d["version"] = parse_version_str(version_str="1.0.0", log=log)
+    info_d["managed_values"] = managed_values
+    info_d["managed_files"] = managed_files
+    with open(os.path.join(project_dir, "versipy.yaml"), "w") as fp:
+        fp.write(ordered_yaml_str(info_d, Dumper=yaml.Dumper))
+
+    log.debug("Rendering managed files")
+    cwd = os.getcwd()
+    os.chdir(project_dir)
+    try:
+        update_managed_files(info_d=info_d, overwrite=True, dry=False, log=log)
+    finally:
+        os.chdir(cwd)
+
+    if not git_remote:
+        return None
+
+    log.debug("Creating git repository and local bare remote")
+    remote_dir = os.path.abspath(project_dir).rstrip(os.sep) + "_remote.git"
+    Repo.init(remote_dir, bare=True)
+    repo = Repo.init(project_dir)
+    with repo.config_writer() as cw:
+        cw.set_value("user", "name", "versipy")
+        cw.set_value("user", "email", "versipy@localhost")
+    repo.git.add(A=True)
+    repo.git.commit(m="Synthetic project")
+    repo.create_remote("origin", remote_dir)
+    repo.git.push("-u", "origin", repo.active_branch.name)
+    return remote_dir
+
+
+def run_versipy_command(args, cwd):
+    """
+    Run a versipy command in a child process and return its exit code, wall time, peak RSS in MB and standard error.
+    The peak RSS is only available on platforms providing the resource module
+    """
+    cmd = [sys.executable, "-c", "from versipy.__main__ import main; main()"] + args
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if resource and hasattr(os, "wait4"):
+        stderr = proc.stderr.read().decode()
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+        peak_rss = rusage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    else:
+        stderr = proc.communicate()[1].decode()
+        peak_rss = None
+    proc.stderr.close()
+    return proc.returncode, time.perf_counter() - start, peak_rss, stderr
@@ -6,8 +6,16 @@
 import copy
 from collections import OrderedDict
 import datetime
+import sys
+import time
+import signal
+import threading
+import http.client
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 
 # Third party imports
+import yaml
 
 # Local imports
 from versipy.common import *
@@ -19,11 +27,13 @@ def init_repo(
     versipy_fn: str = "versipy.yaml",
     versipy_history_fn: str = "versipy_history.txt",
     overwrite: bool = False,
+    json_output: bool = False,
     verbose: bool = False,
     quiet: bool = False,
     **kwargs,
 ):
     """
+    Write template versipy files, and add the lock and cache files created by versipy to the .gitignore file
     * versipy_fn
         Path to write a template versipy YAML file
     * versipy_history_fn
@@ -33,13 +43,15 @@ def init_repo(
     """
     # Init method
     opt_summary_dict = opt_summary(local_opt=locals())
-    log = get_logger(name="versipy init_repo", verbose=verbose, quiet=quiet)
+    log = get_logger(name="versipy init_repo", verbose=verbose, quiet=quiet, json_output=json_output)
 
     log.warning("Generating example template versipy YAML file")
     log_dict(opt_summary_dict, log.debug, "Options summary")
+    start = time.perf_counter()
 
     info_d = get_versipy_yaml_template()
 
+    transaction = FileTransaction(log=log)
     update_versipy_files(
         info_d=info_d,
         versipy_fn=versipy_fn,
@@ -47,11 +59,29 @@ def init_repo(
         comment="Initialise versipy history",
         overwrite=overwrite,
         dry=False,
+        transaction=transaction,
         log=log,
     )
+    update_gitignore(
+        pattern_list=[".versipy_cache.json", ".{}.lock".format(os.path.basename(versipy_fn))],
+        transaction=transaction,
+        log=log,
+    )
+    transaction.commit()
 
+    if json_output:
+        res = OrderedDict()
+        res["command"] = "init_repo"
+        res["version"] = get_version_str(info_d["version"])
+        res["files_written"] = transaction.committed
+        res["files_skipped"] = transaction.skipped
+        res["timings"] = OrderedDict(total=round(time.perf_counter() - start, 3))
+        json_print(res)
 
-def current_version(versipy_fn: str = "versipy.yaml", verbose: bool = False, quiet: bool = False, **kwargs):
+
+def current_version(
+    versipy_fn: str = "versipy.yaml", json_output: bool = False, verbose: bool = False, quiet: bool = False, **kwargs
+):
     """
     Return the current package version
     * versipy_fn
@@ -59,7 +89,7 @@ def current_version(versipy_fn: str = "versipy.yaml", verbose: bool = False, qui
     """
     # Init method
     opt_summary_dict = opt_summary(local_opt=locals())
-    log = get_logger(name="versipy bump_up", verbose=verbose, quiet=quiet)
+    log = get_logger(name="versipy bump_up", verbose=verbose, quiet=quiet, json_output=json_output)
 
     log.warning("Bumping up version package version")
     log.info("Checking options and input files")
@@ -69,7 +99,10 @@ def current_version(versipy_fn: str = "versipy.yaml", verbose: bool = False, qui
     info_d = get_versipy_yaml(versipy_fn=versipy_fn, log=log)
     version_str = get_version_str(info_d["version"])
 
-    stdout_print(version_str)
+    if json_output:
+        json_print(OrderedDict([("command", "current_version"), ("version", version_str)]))
+    else:
+        stdout_print(version_str)
 
 
 def bump_up_version(
@@ -88,6 +121,15 @@ def bump_up_version(
     git_tag: bool = False,
     comment: str = "Versipy auto bump-up",
     dry: bool = False,
+    dry_json: bool = False,
+    threads: int = 4,
+    lock: bool = False,
+    optimistic: bool = False,
+    retries: int = 10,
+    pipeline: bool = False,
+    render_cache_dir: str = "",
+    render_cache_size: int = 512,
+    json_output: bool = False,
     verbose: bool = False,
     quiet: bool = False,
     **kwargs,
@@ -126,56 +168,110 @@ def bump_up_version(
     * comment
         Comment used for the history file and the git commit is used in combination with `git_push`
     * dry
-        Dry run, simulate version update but don't change files
+        Dry run, simulate version update but don't change files. Only the changed files are reported with a compact diff
+    * dry_json
+        Report the dry run change set as JSON lines (one record per changed file) instead of human readable text
+    * threads
+        Number of files rendered in parallel during a dry run or with pipeline
+    * lock
+        Hold an advisory lock on the versipy file during the whole update to serialise concurrent version changes
+    * optimistic
+        Render files without lock and retry if the versipy file was modified concurrently before committing the changes
+    * retries
+        Maximal number of retries in optimistic mode
+    * pipeline
+        Render and write managed files concurrently with asyncio, store their git objects as soon as they are written
+        and push the changes and tag together in the background (used in combination with `git_push`)
+    * render_cache_dir
+        Directory of a content addressed cache of rendered files, that can be shared across runs (disabled if empty)
+    * render_cache_size
+        Maximal size of the render cache in MB. Least recently used entries are evicted first
     """
     # Init method
     opt_summary_dict = opt_summary(local_opt=locals())
-    log = get_logger(name="versipy bump_up", verbose=verbose, quiet=quiet)
+    log = get_logger(name="versipy bump_up", verbose=verbose, quiet=quiet, json_output=json_output)
     log.warning("Bump up version package version")
 
     log.info("Checking options and input files")
     log_dict(opt_summary_dict, log.debug, "Options summary")
+    start = time.perf_counter()
 
-    # Load and check file
-    info_d = get_versipy_yaml(versipy_fn=versipy_fn, log=log)
-    previous_version_str = get_version_str(info_d["version"])
-
-    log.info("Incrementing version number")
-    info_d["version"] = increment_version(
-        version_d=info_d["version"],
-        major=major,
-        minor=minor,
-        micro=micro,
-        a=alpha,
-        b=beta,
-        rc=rc,
-        post=post,
-        dev=dev,
-        log=log,
-    )
-    version_str = get_version_str(info_d["version"])
+    def version_func(version_d):
+        log.info("Incrementing version number")
+        return increment_version(
+            version_d=version_d,
+            major=major,
+            minor=minor,
+            micro=micro,
+            a=alpha,
+            b=beta,
+            rc=rc,
+            post=post,
+            dev=dev,
+            log=log,
+        )
 
-    log.info("Update managed files")
-    update_managed_files(info_d=info_d, overwrite=overwrite, dry=dry, log=log)
-    update_versipy_files(
-        info_d=info_d,
+    odb = get_git_odb(log=log) if pipeline and git_push and not dry else None
+    transaction = FileTransaction(log=log, odb=odb)
+    render_cache = None
+    if render_cache_dir:
+        render_cache = RenderCache(cache_dir=render_cache_dir, max_size=render_cache_size, log=log)
+    changes = [] if json_output and dry else None
+    info_d, previous_version_str, version_str = update_version(
+        version_func=version_func,
         versipy_fn=versipy_fn,
         versipy_history_fn=versipy_history_fn,
         comment=comment,
         overwrite=overwrite,
         dry=dry,
+        dry_json=dry_json,
+        threads=threads,
+        lock=lock,
+        optimistic=optimistic,
+        retries=retries,
+        pipeline=pipeline,
+        transaction=transaction,
+        render_cache=render_cache,
+        changes=changes,
         log=log,
     )
+    if render_cache:
+        render_cache.evict()
+    timings = OrderedDict(update=round(time.perf_counter() - start, 3))
 
     # Optional git tagging
+    git_res = None
     if not dry and git_push:
         log.info("Attempting set tag and to push files to remote repository")
-        managed_files = [f for f in info_d["managed_files"].values()]
-        extra_files = [versipy_fn, versipy_history_fn]
-        git_files(files=managed_files + extra_files, version=version_str, comment=comment, git_tag=git_tag, log=log)
+        git_start = time.perf_counter()
+        if odb:
+            tags = [version_str] if git_tag else []
+            git_res = git_blobs(blob_d=transaction.blobs, comment=comment, tags=tags, log=log)
+        else:
+            managed_files = list(get_managed_files(info_d, log=log).values())
+            extra_files = [versipy_fn, versipy_history_fn]
+            git_res = git_files(
+                files=managed_files + extra_files, version=version_str, comment=comment, git_tag=git_tag, log=log
+            )
+        timings["git"] = round(time.perf_counter() - git_start, 3)
+    timings["total"] = round(time.perf_counter() - start, 3)
 
     log.warning("Version updated: {} > {}".format(previous_version_str, version_str))
 
+    if json_output:
+        res = OrderedDict()
+        res["command"] = "bump_up_version"
+        res["previous_version"] = previous_version_str
+        res["version"] = version_str
+        res["dry"] = dry
+        res["files_written"] = transaction.committed
+        res["files_skipped"] = transaction.skipped
+        if dry:
+            res["files_changed"] = changes
+        res["git"] = git_res
+        res["timings"] = timings
+        json_print(res)
+
 
 def set_version(
     version_str: str,
@@ -186,6 +282,15 @@ def set_version(
     git_tag: bool = False,
     comment: str = "Manually set version",
     dry: bool = False,
+    dry_json: bool = False,
+    threads: int = 4,
+    lock: bool = False,
+    optimistic: bool = False,
+    retries: int = 10,
+    pipeline: bool = False,
+    render_cache_dir: str = "",
+    render_cache_size: int = 512,
+    json_output: bool = False,
     verbose: bool = False,
     quiet: bool = False,
     **kwargs,
@@ -209,41 +314,958 @@ def set_version(
     * comment
         Comment used for the history file and the git commit is used in combination with `git_push`
     * dry
-        Dry run, simulate version update but don't change files
+        Dry run, simulate version update but don't change files. Only the changed files are reported with a compact diff
+    * dry_json
+        Report the dry run change set as JSON lines (one record per changed file) instead of human readable text
+    * threads
+        Number of files rendered in parallel during a dry run or with pipeline
+    * lock
+        Hold an advisory lock on the versipy file during the whole update to serialise concurrent version changes
+    * optimistic
+        Render files without lock and retry if the versipy file was modified concurrently before committing the changes
+    * retries
+        Maximal number of retries in optimistic mode
+    * pipeline
+        Render and write managed files concurrently with asyncio, store their git objects as soon as they are written
+        and push the changes and tag together in the background (used in combination with `git_push`)
+    * render_cache_dir
+        Directory of a content addressed cache of rendered files, that can be shared across runs (disabled if empty)
+    * render_cache_size
+        Maximal size of the render cache in MB. Least recently used entries are evicted first
     """
     # Init method
     opt_summary_dict = opt_summary(local_opt=locals())
-    log = get_logger(name="versipy bump_up", verbose=verbose, quiet=quiet)
+    log = get_logger(name="versipy bump_up", verbose=verbose, quiet=quiet, json_output=json_output)
     log.warning("Bump up version package version")
 
     log.info("Checking options and input files")
     log_dict(opt_summary_dict, log.debug, "Options summary")
+    start = time.perf_counter()
 
-    # Load and check file
-    info_d = get_versipy_yaml(versipy_fn=versipy_fn, log=log)
-    previous_version_str = get_version_str(info_d["version"])
+    new_version_d = parse_version_str(version_str=version_str, log=log)
 
-    log.info("Set version number")
-    info_d["version"] = parse_version_str(version_str=version_str, log=log)
-    version_str = get_version_str(info_d["version"])
+    def version_func(version_d):
+        log.info("Set version number")
+        return copy.deepcopy(new_version_d)
 
-    log.info("Update managed files")
-    update_managed_files(info_d=info_d, overwrite=overwrite, dry=dry, log=log)
-    update_versipy_files(
-        info_d=info_d,
+    odb = get_git_odb(log=log) if pipeline and git_push and not dry else None
+    transaction = FileTransaction(log=log, odb=odb)
+    render_cache = None
+    if render_cache_dir:
+        render_cache = RenderCache(cache_dir=render_cache_dir, max_size=render_cache_size, log=log)
+    changes = [] if json_output and dry else None
+    info_d, previous_version_str, version_str = update_version(
+        version_func=version_func,
         versipy_fn=versipy_fn,
         versipy_history_fn=versipy_history_fn,
         comment=comment,
         overwrite=overwrite,
         dry=dry,
+        dry_json=dry_json,
+        threads=threads,
+        lock=lock,
+        optimistic=optimistic,
+        retries=retries,
+        pipeline=pipeline,
+        transaction=transaction,
+        render_cache=render_cache,
+        changes=changes,
         log=log,
     )
+    if render_cache:
+        render_cache.evict()
+    timings = OrderedDict(update=round(time.perf_counter() - start, 3))
 
     # Optional git tagging
+    git_res = None
     if git_push and not dry:
         log.info("Attempting set tag and to push files to remote repository")
-        managed_files = [f for f in info_d["managed_files"].values()]
-        extra_files = [versipy_fn, versipy_history_fn]
-        git_files(files=managed_files + extra_files, version=version_str, comment=comment, git_tag=git_tag, log=log)
+        git_start = time.perf_counter()
+        if odb:
+            tags = [version_str] if git_tag else []
+            git_res = git_blobs(blob_d=transaction.blobs, comment=comment, tags=tags, log=log)
+        else:
+            managed_files = list(get_managed_files(info_d, log=log).values())
+            extra_files = [versipy_fn, versipy_history_fn]
+            git_res = git_files(
+                files=managed_files + extra_files, version=version_str, comment=comment, git_tag=git_tag, log=log
+            )
+        timings["git"] = round(time.perf_counter() - git_start, 3)
+    timings["total"] = round(time.perf_counter() - start, 3)
 
     log.warning("Version updated: {} > {}".format(previous_version_str, version_str))
+
+    if json_output:
+        res = OrderedDict()
+        res["command"] = "set_version"
+        res["previous_version"] = previous_version_str
+        res["version"] = version_str
+        res["dry"] = dry
+        res["files_written"] = transaction.committed
+        res["files_skipped"] = transaction.skipped
+        if dry:
+            res["files_changed"] = changes
+        res["git"] = git_res
+        res["timings"] = timings
+        json_print(res)
+
+
+def check(
+    versipy_fn: str = "versipy.yaml",
+    diff: bool = False,
+    cache_fn: str = ".versipy_cache.json",
+    threads: int = 4,
+    json_output: bool = False,
+    verbose: bool = False,
+    quiet: bool = False,
+    **kwargs,
+):
+    """
+    Check that all the managed files are up to date with the versipy YAML file and their templates, without modifying
+    them. Only the mismatching files are reported and the command exits with a non-zero status if any is found.
+    * versipy_fn
+        Path to the versipy YAML info file containing package metadata
+    * diff
+        Display a unified diff between the current and the expected content of mismatching files
+    * cache_fn
+        Path to a cache file used to skip the check if nothing changed since the last successful run (empty to disable)
+    * threads
+        Number of files rendered and compared in parallel
+    """
+    # Init method
+    opt_summary_dict = opt_summary(local_opt=locals())
+    log = get_logger(name="versipy check", verbose=verbose, quiet=quiet, json_output=json_output)
+    log.warning("Checking managed files")
+
+    log.info("Checking options and input files")
+    log_dict(opt_summary_dict, log.debug, "Options summary")
+    start = time.perf_counter()
+
+    def print_record(mismatch_list, cached):
+        res = OrderedDict()
+        res["command"] = "check"
+        res["up_to_date"] = not mismatch_list
+        res["cached"] = cached
+        res["mismatches"] = mismatch_list
+        res["timings"] = OrderedDict(total=round(time.perf_counter() - start, 3))
+        json_print(res)
+
+    # Load and check file
+    info_d = get_versipy_yaml(versipy_fn=versipy_fn, log=log)
+    files_d = get_managed_files(info_d, log=log, cache_fn=cache_fn)
+
+    # Files signature used to bypass the full check
+    signature = OrderedDict()
+    signature["versipy"] = file_hash(versipy_fn)
+    signature["files"] = OrderedDict()
+    for src_fn, dest_fn in files_d.items():
+        signature["files"][dest_fn] = [file_stat_signature(src_fn), file_stat_signature(dest_fn)]
+
+    cache_d = load_cache(cache_fn) if cache_fn else {}
+    if cache_d.get("check") == signature:
+        log.warning("All managed files are up to date (cached)")
+        if json_output:
+            print_record(mismatch_list=[], cached=True)
+        return
+
+    log.info("Render and compare managed files")
+    render_values = get_render_values(info_d)
+    mismatch_list = []
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        futures = [
+            executor.submit(diff_managed_file, src_fn=src_fn, dest_fn=dest_fn, render_values=render_values, diff=diff)
+            for src_fn, dest_fn in files_d.items()
+        ]
+        for future in futures:
+            d = future.result()
+            if d["status"] == "unchanged":
+                log.debug("File {} is up to date".format(d["file"]))
+            else:
+                mismatch_list.append(d)
+                log.error("File {} is not up to date ({})".format(d["file"], d["status"]))
+                if d["diff"] and not json_output:
+                    stdout_print("".join(d["diff"]))
+
+    if mismatch_list:
+        log.warning("{} managed file(s) are not up to date".format(len(mismatch_list)))
+        if json_output:
+            print_record(mismatch_list=mismatch_list, cached=False)
+        sys.exit(1)
+
+    if cache_fn:
+        cache_d["check"] = signature
+        dump_cache(cache_d, cache_fn)
+    log.warning("All managed files are up to date")
+    if json_output:
+        print_record(mismatch_list=[], cached=False)
+
+
+def scan_stale(
+    old_version: str = "",
+    new_version: str = "",
+    versipy_history_fn: str = "versipy_history.txt",
+    threads: int = 8,
+    json_output: bool = False,
+    verbose: bool = False,
+    quiet: bool = False,
+    **kwargs,
+):
+    """
+    Scan the working tree for stale occurrences of the previous version string, for example in files that are not
+    managed by versipy. Files ignored by git are skipped. By default the previous and new versions are taken from the
+    last two entries of the history file written by bump_up_version and set_version. The command exits with a non-zero
+    status if any occurrence is found.
+    * old_version
+        Version string to search for (default: previous version from the history file)
+    * new_version
+        Current version string, only used for reporting (default: last version from the history file if old_version is
+        not set)
+    * versipy_history_fn
+        Path to the versipy history file
+    * threads
+        Number of files scanned in parallel
+    """
+    # Init method
+    opt_summary_dict = opt_summary(local_opt=locals())
+    log = get_logger(name="versipy scan_stale", verbose=verbose, quiet=quiet, json_output=json_output)
+    log.warning("Scanning repository for stale version strings")
+
+    log.info("Checking options and input files")
+    log_dict(opt_summary_dict, log.debug, "Options summary")
+    start = time.perf_counter()
+
+    def print_record(hit_list):
+        res = OrderedDict()
+        res["command"] = "scan_stale"
+        res["old_version"] = old_version
+        res["new_version"] = new_version
+        res["hits"] = hit_list
+        res["timings"] = OrderedDict(total=round(time.perf_counter() - start, 3))
+        json_print(res)
+
+    # The history file is only required to find the version to search for
+    if not old_version:
+        log.debug("Get versions from history file")
+        history_versions = get_history_versions(versipy_history_fn, n=2)
+        if len(history_versions) < 2:
+            raise ValueError("Cannot find a previous version in history file {}".format(versipy_history_fn))
+        if not new_version:
+            new_version = history_versions[-1]
+        old_version = history_versions[-2]
+
+    if not is_canonical_version(old_version):
+        raise ValueError("Version {} is not a valid PEP canonical version".format(old_version))
+    if old_version == new_version:
+        log.warning("Previous and current versions are identical: {}".format(old_version))
+        if json_output:
+            print_record(hit_list=[])
+        return
+
+    log.info("Listing files in working tree")
+    fn_list = list_repo_files(log=log, exclude=[versipy_history_fn])
+    log.debug("{} files to scan".format(len(fn_list)))
+
+    log.info("Searching for version {} (current version {})".format(old_version, new_version))
+    regex = get_version_regex(old_version)
+    hit_list = []
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        for hits in executor.map(lambda fn: scan_file(fn, regex), fn_list):
+            for fn, line_num, col_num, line in hits:
+                hit_list.append(OrderedDict([("file", fn), ("line", line_num), ("column", col_num), ("text", line)]))
+                if not json_output:
+                    stdout_print("{}:{}:{}: {}\n".format(fn, line_num, col_num, line))
+
+    if json_output:
+        print_record(hit_list=hit_list)
+    if hit_list:
+        log.warning("Found {} stale occurrence(s) of version {}".format(len(hit_list), old_version))
+        sys.exit(1)
+    log.warning("No stale occurrence of version {} found".format(old_version))
+
+
+def serve(
+    versipy_fn: str = "versipy.yaml",
+    versipy_history_fn: str = "versipy_history.txt",
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    commit_interval: float = 0.005,
+    comment: str = "Versipy server allocation",
+    json_output: bool = False,
+    verbose: bool = False,
+    quiet: bool = False,
+    **kwargs,
+):
+    """
+    Run a local HTTP server holding the package version in memory and allocating unique, monotonically increasing
+    dev or post versions to concurrent clients (GET /next?level=dev or /next?level=post, GET /current for the current
+    version). Allocations are persisted to the versipy YAML and history files by group commits before being returned.
+    Managed files are not rendered. Stop the server with Ctrl+C or SIGTERM.
+    * versipy_fn
+        Path to the versipy YAML info file containing package metadata
+    * versipy_history_fn
+        Path to the versipy history file
+    * host
+        Address to bind the server to
+    * port
+        Port to listen to
+    * commit_interval
+        Time in seconds to wait for more allocations before a group commit. Clients get their version once it is
+        committed
+    * comment
+        Comment used for the history file entries
+    """
+    # Init method
+    opt_summary_dict = opt_summary(local_opt=locals())
+    log = get_logger(name="versipy serve", verbose=verbose, quiet=quiet, json_output=json_output)
+    log.warning("Starting version allocation server")
+
+    log.info("Checking options and input files")
+    log_dict(opt_summary_dict, log.debug, "Options summary")
+    start = time.perf_counter()
+
+    allocator = VersionAllocator(versipy_fn=versipy_fn, versipy_history_fn=versipy_history_fn, comment=comment, log=log)
+    server = ThreadingHTTPServer((host, port), get_version_request_handler(allocator))
+
+    # Group commit in a background thread as soon as versions are allocated
+    stop = threading.Event()
+
+    def commit_loop():
+        while not stop.is_set():
+            if not allocator.has_pending.wait(0.1):
+                continue
+            stop.wait(commit_interval)
+            try:
+                allocator.flush()
+            except Exception as E:
+                log.error("Failed to commit allocated versions: {}".format(E))
+
+    commit_thread = threading.Thread(target=commit_loop, daemon=True)
+    commit_thread.start()
+
+    def sigterm_handler(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, sigterm_handler)
+
+    log.warning("Serving version {} on http://{}:{}".format(allocator.current(), host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Shutting down server")
+    finally:
+        server.server_close()
+        stop.set()
+        commit_thread.join()
+        allocator.flush()
+
+    log.warning("Allocated {} version(s), current version {}".format(allocator.n_allocated, allocator.current()))
+
+    if json_output:
+        res = OrderedDict()
+        res["command"] = "serve"
+        res["version"] = allocator.current()
+        res["allocated"] = allocator.n_allocated
+        res["timings"] = OrderedDict(total=round(time.perf_counter() - start, 3))
+        json_print(res)
+
+
+def serve_bench(
+    url: str = "http://127.0.0.1:8765",
+    level: str = "dev",
+    n_requests: int = 10000,
+    threads: int = 8,
+    json_output: bool = False,
+    verbose: bool = False,
+    quiet: bool = False,
+    **kwargs,
+):
+    """
+    Load test client for the versipy version allocation server. Request versions from concurrent persistent
+    connections, check that all the allocated versions are unique and report the request rate and latencies
+    * url
+        Base URL of the versipy server
+    * level
+        Version level to allocate (dev or post)
+    * n_requests
+        Total number of version allocation requests
+    * threads
+        Number of concurrent client connections
+    """
+    # Init method
+    opt_summary_dict = opt_summary(local_opt=locals())
+    log = get_logger(name="versipy serve_bench", verbose=verbose, quiet=quiet, json_output=json_output)
+    log.warning("Load testing version allocation server")
+    log_dict(opt_summary_dict, log.debug, "Options summary")
+
+    url = urlparse(url)
+    threads = max(threads, 1)
+
+    def client(n):
+        conn = http.client.HTTPConnection(url.hostname, url.port)
+        versions, latencies = [], []
+        try:
+            for _ in range(n):
+                t = time.perf_counter()
+                conn.request("GET", "/next?level={}".format(level))
+                resp = conn.getresponse()
+                body = resp.read().decode().strip()
+                if resp.status != 200:
+                    raise IOError("Server error {}: {}".format(resp.status, body))
+                latencies.append(time.perf_counter() - t)
+                versions.append(body)
+        finally:
+            conn.close()
+        return versions, latencies
+
+    n_list = [n_requests // threads + (1 if i < n_requests % threads else 0) for i in range(threads)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(client, n_list))
+    elapsed = time.perf_counter() - start
+
+    versions = [v for vl, _ in results for v in vl]
+    latencies = sorted(l for _, ll in results for l in ll)
+    n_duplicates = len(versions) - len(set(versions))
+
+    stats_d = OrderedDict()
+    stats_d["Requests"] = len(versions)
+    stats_d["Duplicated versions"] = n_duplicates
+    stats_d["Wall time (s)"] = round(elapsed, 3)
+    stats_d["Requests per second"] = round(len(versions) / elapsed, 1) if elapsed else 0
+    if latencies:
+        stats_d["Median latency (ms)"] = round(latencies[len(latencies) // 2] * 1000, 3)
+        stats_d["99th percentile latency (ms)"] = round(latencies[int(len(latencies) * 0.99)] * 1000, 3)
+    log_dict(stats_d, log.warning, "Load test results")
+
+    if json_output:
+        res = OrderedDict()
+        res["command"] = "serve_bench"
+        res["requests"] = len(versions)
+        res["duplicated_versions"] = n_duplicates
+        res["requests_per_second"] = stats_d["Requests per second"]
+        if latencies:
+            res["median_latency_ms"] = stats_d["Median latency (ms)"]
+            res["p99_latency_ms"] = stats_d["99th percentile latency (ms)"]
+        res["timings"] = OrderedDict(total=round(elapsed, 3))
+        json_print(res)
+
+    if n_duplicates:
+        log.error("The server allocated {} duplicated versions".format(n_duplicates))
+        sys.exit(1)
+
+
+def render_matrix(
+    versions: [str] = [],
+    matrix_fn: str = "",
+    output_dir: str = "versipy_matrix",
+    versipy_fn: str = "versipy.yaml",
+    threads: int = 4,
+    json_output: bool = False,
+    verbose: bool = False,
+    quiet: bool = False,
+    **kwargs,
+):
+    """
+    Render the managed files for several versions in a single pass, for example one per supported release line. Each
+    template is read and tokenized once, then rendered for all the versions in parallel. Files are written in a
+    separate directory per version (output_dir/version/destination). The versipy files and the managed files are not
+    modified.
+    * versions
+        List of python PEP compliant version strings to render
+    * matrix_fn
+        Optional YAML file mapping version strings to managed values overrides for this version. Overrides must be
+        existing managed values, and all the entries are read as strings
+    * output_dir
+        Directory where to write the rendered files, in one subdirectory per version
+    * versipy_fn
+        Path to the versipy YAML info file containing package metadata
+    * threads
+        Number of templates rendered in parallel
+    """
+    # Init method
+    opt_summary_dict = opt_summary(local_opt=locals())
+    log = get_logger(name="versipy render_matrix", verbose=verbose, quiet=quiet, json_output=json_output)
+    log.warning("Rendering managed files for multiple versions")
+
+    log.info("Checking options and input files")
+    log_dict(opt_summary_dict, log.debug, "Options summary")
+
+    start = time.perf_counter()
+
+    # Load and check file
+    info_d = get_versipy_yaml(versipy_fn=versipy_fn, log=log)
+
+    # Collect versions and their values overrides
+    matrix_d = OrderedDict((v, OrderedDict()) for v in versions)
+    if matrix_fn:
+        # Load all scalars as strings, so that versions and values like 1.10 are not read as floats
+        for v, overrides in (ordered_load_yaml(matrix_fn, Loader=yaml.BaseLoader) or {}).items():
+            matrix_d[v] = overrides or OrderedDict()
+    if not matrix_d:
+        raise ValueError("No version to render. Provide versions and/or a matrix file")
+
+    log.info("Validating versions and resolving values")
+    variant_list = []
+    keys = set()
+    for v, overrides in matrix_d.items():
+        unknown_keys = [k for k in overrides if k not in info_d["managed_values"]]
+        if unknown_keys:
+            raise ValueError(
+                "Matrix overrides for version {} are not managed values: {}".format(v, ", ".join(unknown_keys))
+            )
+        version_str = get_version_str(parse_version_str(version_str=v, log=log))
+        values_d = OrderedDict(info_d["managed_values"])
+        values_d.update(overrides)
+        values_d = resolve_managed_values(values_d, version_str)
+        keys.update(values_d)
+        variant_list.append((version_str, values_d))
+    regex = get_placeholder_regex(keys)
+
+    log.info("Rendering {} version(s)".format(len(variant_list)))
+    files_d = get_managed_files(info_d, log=log)
+    written_list = []
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        futures = [
+            executor.submit(render_matrix_file, src_fn, dest_fn, variant_list, regex, output_dir)
+            for src_fn, dest_fn in files_d.items()
+        ]
+        for future in futures:
+            for out_fn in future.result():
+                log.debug("Written file {}".format(out_fn))
+                written_list.append(out_fn)
+
+    log.warning("{} file(s) written in {}".format(len(written_list), output_dir))
+
+    if json_output:
+        res = OrderedDict()
+        res["command"] = "render_matrix"
+        res["versions"] = [version_str for version_str, _ in variant_list]
+        res["output_dir"] = output_dir
+        res["files_written"] = written_list
+        res["timings"] = OrderedDict(total=round(time.perf_counter() - start, 3))
+        json_print(res)
+
+
+def changelog(
+    from_version: str = "",
+    to_version: str = "",
+    versipy_history_fn: str = "versipy_history.txt",
+    output_fn: str = "",
+    json_output: bool = False,
+    verbose: bool = False,
+    quiet: bool = False,
+    **kwargs,
+):
+    """
+    Generate Markdown release notes between 2 versions, combining the versipy history file with the git log. Commits
+    are grouped under the first version recorded in the history after them
+    * from_version
+        Start version, excluded from the release notes (default: version preceding to_version in the history file)
+    * to_version
+        End version, included in the release notes (default: last version in the history file)
+    * versipy_history_fn
+        Path to the versipy history file
+    * output_fn
+        Path to a file where to write the release notes (default: stdout)
+    """
+    # Init method
+    opt_summary_dict = opt_summary(local_opt=locals())
+    log = get_logger(name="versipy changelog", verbose=verbose, quiet=quiet, json_output=json_output)
+    log.warning("Generating changelog")
+
+    log.info("Checking options and input files")
+    log_dict(opt_summary_dict, log.debug, "Options summary")
+
+    start = time.perf_counter()
+
+    log.info("Finding version boundaries in history file")
+    from_entry, entries = get_history_range(
+        versipy_history_fn=versipy_history_fn, from_version=from_version, to_version=to_version
+    )
+    log.debug("{} version(s) between {} and {}".format(len(entries), from_entry[1], entries[-1][1]))
+
+    log.info("Reading git log")
+    groups = group_commits_by_version(from_entry=from_entry, entries=entries)
+    log.debug("{} commit(s) found".format(sum(len(g) for g in groups)))
+
+    md = changelog_markdown(from_entry=from_entry, entries=entries, groups=groups)
+    if output_fn:
+        mkbasedir(output_fn)
+        with open(output_fn, "w") as fp:
+            fp.write(md)
+        log.warning("Changelog written to {}".format(output_fn))
+    elif not json_output:
+        stdout_print(md)
+
+    if json_output:
+        res = OrderedDict()
+        res["command"] = "changelog"
+        res["from_version"] = from_entry[1]
+        res["to_version"] = entries[-1][1]
+        res["versions"] = [version for _, version, _ in entries]
+        res["commits"] = sum(len(g) for g in groups)
+        res["output_fn"] = output_fn or None
+        res["changelog"] = None if output_fn else md
+        res["timings"] = OrderedDict(total=round(time.perf_counter() - start, 3))
+        json_print(res)
+
+
+def bulk_version(
+    manifest_fn: str,
+    versipy_fn: str = "versipy.yaml",
+    versipy_history_fn: str = "versipy_history.txt",
+    git_push: bool = False,
+    git_tag: bool = False,
+    tag_format: str = "{name}-{version}",
+    comment: str = "Versipy bulk version update",
+    dry: bool = False,
+    threads: int = 4,
+    lock: bool = False,
+    json_output: bool = False,
+    verbose: bool = False,
+    quiet: bool = False,
+    **kwargs,
+):
+    """
+    Set or bump up the versions of several projects at once from a manifest file, in a single process. All the target
+    versions are validated before any file is modified, then the managed files of all projects are rendered in parallel
+    and committed together. Existing files are overwritten without confirmation. With git_push, all the changes are
+    committed at once and pushed together with all the version tags.
+    * manifest_fn
+        YAML (mapping) or CSV (2 columns) file listing project directories and either a PEP canonical version to set or
+        comma separated levels to increment (major, minor, micro, alpha, beta, rc, post, dev)
+    * versipy_fn
+        Name of the versipy YAML info file in each project directory
+    * versipy_history_fn
+        Name of the versipy history file in each project directory
+    * git_push
+        Commit and push the files modified by versipy in a single commit
+    * git_tag
+        Create and publish a git tag for each project new version (requires git_push to be set)
+    * tag_format
+        Format of the tags, with {name} the project package name (or directory name) and {version} its new version
+    * comment
+        Comment used for the history files and the git commit
+    * dry
+        Dry run, report the version changes and the managed files that would change without modifying them
+    * threads
+        Number of files rendered in parallel
+    * lock
+        Hold an advisory lock on all the versipy files during the whole update
+    """
+    # Init method
+    opt_summary_dict = opt_summary(local_opt=locals())
+    log = get_logger(name="versipy bulk_version", verbose=verbose, quiet=quiet, json_output=json_output)
+    log.warning("Bulk version update")
+
+    log.info("Checking options and input files")
+    log_dict(opt_summary_dict, log.debug, "Options summary")
+    start = time.perf_counter()
+    timings = OrderedDict()
+    manifest_d = read_manifest(manifest_fn)
+
+    # The same project listed twice would deadlock with lock, or lose one of its updates without
+    real_dir_d = OrderedDict()
+    for project_dir in manifest_d:
+        real_dir = os.path.realpath(project_dir)
+        if real_dir in real_dir_d:
+            raise ValueError(
+                "Projects {} and {} are the same directory in manifest {}".format(
+                    real_dir_d[real_dir], project_dir, manifest_fn
+                )
+            )
+        real_dir_d[real_dir] = project_dir
+
+    def print_record(project_list, transaction=None, changes=None, git_res=None):
+        timings["total"] = round(time.perf_counter() - start, 3)
+        res = OrderedDict()
+        res["command"] = "bulk_version"
+        res["dry"] = dry
+        res["projects"] = [
+            OrderedDict(
+                [("path", project_dir), ("previous_version", previous), ("version", get_version_str(info_d["version"]))]
+            )
+            for project_dir, info_d, previous in project_list
+        ]
+        res["files_written"] = transaction.committed if transaction is not None else []
+        if dry:
+            res["files_changed"] = changes
+        res["git"] = git_res
+        res["timings"] = timings
+        json_print(res)
+
+    with ExitStack() as stack:
+        if lock and not dry:
+            # Lock in a global order to avoid deadlocks between runs listing the projects in different orders
+            for lock_fn in sorted(os.path.join(real_dir, versipy_fn) for real_dir in real_dir_d):
+                stack.enter_context(FileLock(lock_fn, log=log))
+
+        log.info("Validating {} project(s)".format(len(manifest_d)))
+        project_list = []
+        render_values_d = {}
+        error_list = []
+        for project_dir, target in manifest_d.items():
+            try:
+                info_d = get_versipy_yaml(versipy_fn=os.path.join(project_dir, versipy_fn), log=log)
+                previous_version_str = get_version_str(info_d["version"])
+                info_d["version"] = get_target_version(info_d["version"], target, log)
+                render_values_d[project_dir] = get_render_values(info_d)
+                project_list.append((project_dir, info_d, previous_version_str))
+            except (IOError, ValueError) as E:
+                error_list.append("{}: {}".format(project_dir, E))
+        if error_list:
+            log_list(error_list, log.error, "Invalid projects in manifest")
+            raise ValueError("{} invalid project(s) in manifest {}".format(len(error_list), manifest_fn))
+
+        tags = []
+        if git_push and git_tag:
+            for project_dir, info_d, _ in project_list:
+                name = render_values_d[project_dir][0].get("__package_name__")
+                name = name or os.path.basename(os.path.abspath(project_dir))
+                tags.append(tag_format.format(name=name, version=get_version_str(info_d["version"])))
+            if len(set(tags)) != len(tags):
+                raise ValueError("Duplicated tags, use a tag_format that makes them unique: {}".format(", ".join(tags)))
+
+        for project_dir, info_d, previous_version_str in project_list:
+            log.info("{}: {} > {}".format(project_dir, previous_version_str, get_version_str(info_d["version"])))
+
+        if dry:
+            changes = [] if json_output else None
+            for project_dir, info_d, _ in project_list:
+                dry_run_managed_files(
+                    info_d=prefix_managed_files(info_d, project_dir),
+                    dry_json=False,
+                    threads=threads,
+                    changes=changes,
+                    log=log,
+                )
+            if json_output:
+                print_record(project_list=project_list, changes=changes)
+            return
+
+        log.info("Render managed files")
+        odb = get_git_odb(log=log) if git_push else None
+        transaction = FileTransaction(log=log, odb=odb)
+        try:
+            with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+                futures = []
+                for project_dir, info_d, _ in project_list:
+                    prefixed_d = prefix_managed_files(info_d, project_dir)
+                    render_values = render_values_d[project_dir]
+                    for src_fn, dest_fn in get_managed_files(prefixed_d, log=log).items():
+                        futures.append(executor.submit(stage_managed_file, src_fn, dest_fn, render_values, transaction))
+                for future in futures:
+                    future.result()
+        except:
+            transaction.rollback()
+            raise
+
+        for project_dir, info_d, _ in project_list:
+            update_versipy_files(
+                info_d=info_d,
+                versipy_fn=os.path.join(project_dir, versipy_fn),
+                versipy_history_fn=os.path.join(project_dir, versipy_history_fn),
+                comment=comment,
+                overwrite=True,
+                dry=False,
+                transaction=transaction,
+                log=log,
+            )
+        log.info("Commit file changes")
+        transaction.commit()
+    timings["update"] = round(time.perf_counter() - start, 3)
+
+    # Single git commit and push for all projects
+    git_res = None
+    if git_push:
+        log.info("Attempting to commit, tag and push all files to remote repository")
+        git_start = time.perf_counter()
+        if odb:
+            git_res = git_blobs(blob_d=transaction.blobs, comment=comment, tags=tags, log=log)
+        else:
+            log.info("Failed to push to remote: not a git repository")
+            git_res = OrderedDict(
+                [("commit", None), ("tags", []), ("pushed", False), ("error", "Not a git repository")]
+            )
+        timings["git"] = round(time.perf_counter() - git_start, 3)
+
+    log.warning("{} project version(s) updated".format(len(project_list)))
+    if json_output:
+        print_record(project_list=project_list, transaction=transaction, git_res=git_res)
+
+
+def generate_project(
+    project_dir: str = "versipy_synthetic",
+    n_files: int = 2000,
+    n_values: int = 2000,
+    file_size: int = 4096,
+    n_large_files: int = 2,
+    large_file_size: int = 4194304,
+    n_history: int = 100000,
+    git_remote: bool = False,
+    json_output: bool = False,
+    verbose: bool = False,
+    quiet: bool = False,
+    **kwargs,
+):
+    """
+    Generate a synthetic versipy project to evaluate how versipy behaves with large repositories
+    * project_dir
+        Directory where to generate the project (must not exist)
+    * n_files
+        Number of small managed files
+    * n_values
+        Number of managed values (one in 10 references other values)
+    * file_size
+        Size of the small templates in bytes
+    * n_large_files
+        Number of large managed files
+    * large_file_size
+        Size of the large templates in bytes
+    * n_history
+        Number of lines in the history file
+    * git_remote
+        Initialise a git repository with a local bare remote next to the project directory
+    """
+    # Init method
+    opt_summary_dict = opt_summary(local_opt=locals())
+    log = get_logger(name="versipy generate_project", verbose=verbose, quiet=quiet, json_output=json_output)
+    log.warning("Generating synthetic project")
+    log_dict(opt_summary_dict, log.debug, "Options summary")
+
+    start = time.perf_counter()
+    remote_dir = generate_synthetic_project(
+        project_dir=project_dir,
+        n_files=n_files,
+        n_values=n_values,
+        file_size=file_size,
+        n_large_files=n_large_files,
+        large_file_size=large_file_size,
+        n_history=n_history,
+        git_remote=git_remote,
+        log=log,
+    )
+    log.info("Project generated in {:.3f}s".format(time.perf_counter() - start))
+    if remote_dir:
+        log.info("Git remote: {}".format(remote_dir))
+
+    if json_output:
+        res = OrderedDict()
+        res["command"] = "generate_project"
+        res["project_dir"] = project_dir
+        res["remote_dir"] = remote_dir
+        res["timings"] = OrderedDict(total=round(time.perf_counter() - start, 3))
+        json_print(res)
+
+
+def stress_test(
+    scales: [int] = [100, 1000],
+    project_dir: str = "versipy_stress",
+    file_size: int = 4096,
+    n_large_files: int = 2,
+    large_file_size: int = 4194304,
+    n_history: int = 100000,
+    git_push: bool = False,
+    threads: int = 4,
+    results_fn: str = "",
+    keep: bool = False,
+    json_output: bool = False,
+    verbose: bool = False,
+    quiet: bool = False,
+    **kwargs,
+):
+    """
+    Generate synthetic projects of increasing sizes and time current_version, bump_up_version and set_version against
+    them, each in a separate process. Report the wall time, the peak resident memory and the managed files rendered per
+    second for each command
+    * scales
+        Number of managed files and managed values of each generated project
+    * project_dir
+        Directory where to generate the projects, in one scale_<N> subdirectory per scale (replaced if it exists)
+    * file_size
+        Size of the small templates in bytes
+    * n_large_files
+        Number of large managed files in each project
+    * large_file_size
+        Size of the large templates in bytes
+    * n_history
+        Number of lines in the history files
+    * git_push
+        Also time a bump up with git commit, tag and push to a local bare remote
+    * threads
+        Number of threads used by the timed commands
+    * results_fn
+        Optional TSV file where to write the results
+    * keep
+        Keep the generated projects after the test
+    """
+    # Init method
+    opt_summary_dict = opt_summary(local_opt=locals())
+    log = get_logger(name="versipy stress_test", verbose=verbose, quiet=quiet, json_output=json_output)
+    log.warning("Stress testing versipy with synthetic projects")
+    log_dict(opt_summary_dict, log.debug, "Options summary")
+
+    threads_opt = ["--threads", str(threads), "-q"]
+    commands = [
+        ("current_version", ["current_version", "-q"], False),
+        ("bump_up_version", ["bump_up_version", "--micro", "-o"] + threads_opt, True),
+        ("set_version", ["set_version", "-s", "3.0.0", "-o"] + threads_opt, True),
+    ]
+    if git_push:
+        git_opt = ["--git_push", "--git_tag", "--pipeline"]
+        commands.append(("bump_up_version git", ["bump_up_version", "--micro", "-o"] + git_opt + threads_opt, True))
+
+    os.makedirs(project_dir, exist_ok=True)
+    results = []
+    n_failed = 0
+    for scale in scales:
+        scale_dir = os.path.join(project_dir, "scale_{}".format(scale))
+        remote_dir = os.path.abspath(scale_dir) + "_remote.git"
+        for d in (scale_dir, remote_dir):
+            shutil.rmtree(d, ignore_errors=True)
+
+        log.info("Generating project with {} managed files and values".format(scale))
+        generate_synthetic_project(
+            project_dir=scale_dir,
+            n_files=scale,
+            n_values=scale,
+            file_size=file_size,
+            n_large_files=n_large_files,
+            large_file_size=large_file_size,
+            n_history=n_history,
+            git_remote=git_push,
+            log=log,
+        )
+
+        n_managed = scale + n_large_files
+        for name, args, renders in commands:
+            returncode, wall, peak_rss, stderr = run_versipy_command(args=args, cwd=scale_dir)
+            if returncode:
+                n_failed += 1
+                log.error("{} failed at scale {}: {}".format(name, scale, stderr.strip().splitlines()[-1:]))
+                continue
+            stats_d = OrderedDict()
+            stats_d["scale"] = scale
+            stats_d["command"] = name
+            stats_d["wall_time_s"] = round(wall, 3)
+            stats_d["peak_rss_mb"] = round(peak_rss, 1) if peak_rss is not None else None
+            stats_d["files_per_second"] = round(n_managed / wall, 1) if renders else None
+            log.warning(", ".join("{}: {}".format(k, v) for k, v in stats_d.items()))
+            results.append(stats_d)
+
+        if not keep:
+            for d in (scale_dir, remote_dir):
+                shutil.rmtree(d, ignore_errors=True)
+
+    if results_fn and results:
+        with open(results_fn, "w") as fp:
+            fp.write("\t".join(results[0].keys()) + "\n")
+            for stats_d in results:
+                fp.write("\t".join("NA" if v is None else str(v) for v in stats_d.values()) + "\n")
+        log.info("Results written to {}".format(results_fn))
+
+    if json_output:
+        json_print(OrderedDict([("command", "stress_test"), ("results", results), ("failed", n_failed)]))
+    if n_failed:
+        log.error("{} command(s) failed".format(n_failed))
+        sys.exit(1)